@@ -0,0 +1,141 @@
+""" Checks that the in-process fixer (fixer.py) fixes the commas exactly like
+jsoncomma does.
+
+conformance.json holds the cases: inputs, and the outputs the jsoncomma binary
+gave for them. The outputs are recorded by running the real binary (not the
+stub, which uses fixer.py itself):
+
+    python bench/conformance.py record path/to/jsoncomma
+    python bench/conformance.py
+
+The second command compares fixer.fix with the recorded outputs, and exits with
+a non-zero code if any of them differ, or if some cases haven't been recorded.
+To add a case, add its name and input to conformance.json and record again.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CASES = os.path.join(ROOT, "bench", "conformance.json")
+
+sys.path.insert(0, ROOT)
+
+import fixer  # noqa: E402
+
+TIMEOUT = 10
+
+
+def load_cases():
+    with open(CASES, encoding="utf-8") as fp:
+        return json.load(fp)
+
+
+def save_cases(recording):
+    text = json.dumps(recording, indent=2, ensure_ascii=False)
+    with open(CASES, "w", encoding="utf-8") as fp:
+        # keep the byte order marks visible
+        fp.write(text.replace("\ufeff", "\\ufeff") + "\n")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def executable_version(executable):
+    output = subprocess.check_output([executable, "-version"], timeout=TIMEOUT)
+    return output.decode("utf-8").split(" ")[0].strip()
+
+
+def record(executable):
+    """ fixes every case with the binary, and saves its outputs """
+    recording = load_cases()
+    port = free_port()
+    process = subprocess.Popen(
+        [executable, "server", "-host", "127.0.0.1", "-port", str(port)],
+        stdout=subprocess.PIPE,
+    )
+    try:
+        infos = json.loads(process.stdout.readline().decode("utf-8"))
+        assert infos["kind"] == "started", "server didn't start: {}".format(infos)
+
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=TIMEOUT)
+        for case in recording["cases"]:
+            conn.request("POST", "/", case["input"].encode("utf-8"))
+            resp = conn.getresponse()
+            body = resp.read().decode("utf-8")
+            assert resp.status == 200, "{}: got {} {}".format(
+                case["name"], resp.status, body
+            )
+            case["output"] = body
+
+        conn.request("GET", "/shutdown")
+        conn.getresponse().read()
+        process.wait(timeout=TIMEOUT)
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+    recording["recorded_with"] = executable_version(executable)
+    save_cases(recording)
+    print(
+        "recorded {} cases with jsoncomma {}".format(
+            len(recording["cases"]), recording["recorded_with"]
+        )
+    )
+
+
+def check():
+    """ returns the number of cases fixer.fix gets wrong (or can't be checked) """
+    recording = load_cases()
+    failures = 0
+    for case in recording["cases"]:
+        if "output" not in case:
+            print("{}: not recorded".format(case["name"]))
+            failures += 1
+            continue
+
+        fixed = fixer.fix(case["input"])
+        if fixed != case["output"]:
+            print(
+                "{}: {!r}\n    jsoncomma: {!r}\n    fixer:     {!r}".format(
+                    case["name"], case["input"], case["output"], fixed
+                )
+            )
+            failures += 1
+
+    print(
+        "{} of {} cases match jsoncomma {}".format(
+            len(recording["cases"]) - failures,
+            len(recording["cases"]),
+            recording.get("recorded_with") or "(not recorded yet)",
+        )
+    )
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    recorder = subparsers.add_parser("record", help="record the binary's outputs")
+    recorder.add_argument("executable", help="path to the jsoncomma binary")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.executable)
+    else:
+        sys.exit(1 if check() else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,642 @@
+""" In-memory stand-ins for the sublime and sublime_plugin modules, just enough
+of them to run the plugin outside of the editor.
+
+install() puts them in sys.modules, it has to be called before the plugin is
+imported.
+"""
+
+import bisect
+import heapq
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import types
+
+HIDDEN = 128
+DRAW_NO_FILL = 32
+DRAW_NO_OUTLINE = 256
+
+_platform = {"win32": "windows", "darwin": "osx"}.get(sys.platform, "linux")
+_cache_path = tempfile.mkdtemp(prefix="jsoncomma-bench-")
+_settings = {}
+_resources = {}
+_messages = []
+_ids = iter(range(1, 1 << 30))
+_windows = []
+_clipboard = ""
+# the callbacks waiting for the async thread: (when, sequence, callback)
+_async_queue = []
+_async_condition = threading.Condition()
+_async_sequence = iter(range(1 << 62))
+_async_thread = None
+
+
+class Region:
+    def __init__(self, a, b=None):
+        if b is None:
+            b = a
+        self.a = a
+        self.b = b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return self.end() - self.begin()
+
+    def empty(self):
+        return self.a == self.b
+
+    def cover(self, other):
+        return Region(min(self.begin(), other.begin()), max(self.end(), other.end()))
+
+    def contains(self, other):
+        if isinstance(other, Region):
+            return self.begin() <= other.begin() and other.end() <= self.end()
+        return self.begin() <= other <= self.end()
+
+    def intersects(self, other):
+        return self.begin() < other.end() and other.begin() < self.end()
+
+    def __eq__(self, other):
+        return isinstance(other, Region) and (self.a, self.b) == (other.a, other.b)
+
+    def __hash__(self):
+        return hash((self.a, self.b))
+
+    def __len__(self):
+        return self.size()
+
+    def __repr__(self):
+        return "Region({}, {})".format(self.a, self.b)
+
+
+class Selection:
+
+    """ The regions are stored as [a, b] lists (and copied into Regions when
+    read, like sublime does) so that moving them after an edit is cheap """
+
+    def __init__(self, regions=()):
+        self._points = [[region.a, region.b] for region in regions]
+
+    def __iter__(self):
+        return iter([Region(a, b) for a, b in self._points])
+
+    def __len__(self):
+        return len(self._points)
+
+    def __getitem__(self, index):
+        return Region(*self._points[index])
+
+    def add(self, region):
+        self._points.append([region.a, region.b])
+
+    def add_all(self, regions):
+        for region in regions:
+            self.add(region)
+
+    def clear(self):
+        self._points = []
+
+    def _shift(self, shift):
+        for points in self._points:
+            points[0] = shift(points[0])
+            points[1] = shift(points[1])
+
+
+class Settings:
+    def __init__(self, values=None):
+        self._values = dict(values or {})
+        self._callbacks = {}
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def set(self, key, value):
+        self._values[key] = value
+        for callback in list(self._callbacks.values()):
+            callback()
+
+    def erase(self, key):
+        self._values.pop(key, None)
+
+    def has(self, key):
+        return key in self._values
+
+    def add_on_change(self, tag, callback):
+        self._callbacks[tag] = callback
+
+    def clear_on_change(self, tag):
+        self._callbacks.pop(tag, None)
+
+
+class Edit:
+    pass
+
+
+class Window:
+    def __init__(self, folders=()):
+        self._id = next(_ids)
+        self._folders = list(folders)
+        self._views = []
+        _windows.append(self)
+
+    def id(self):
+        return self._id
+
+    def folders(self):
+        return list(self._folders)
+
+    def views(self):
+        return list(self._views)
+
+    def active_view(self):
+        return self._views[-1] if self._views else None
+
+    def new_file(self):
+        view = View("", window=self)
+        self._views.append(view)
+        return view
+
+    def status_message(self, message):
+        status_message(message)
+
+    def run_command(self, name, args=None):
+        _run_command(name, args, window=self)
+
+
+class View:
+    def __init__(
+        self, text="", *, file_name=None, syntax="Packages/JSON/JSON.sublime-syntax",
+        scope="source.json", window=None
+    ):
+        self._id = next(_ids)
+        self._buffer_id = next(_ids)
+        self._buffer = text
+        # edits not applied to _buffer yet (see _modify)
+        self._pending = []
+        self._lock = threading.RLock()
+        self._file_name = file_name
+        self._scope = scope
+        self._change_count = 0
+        self._saved_change_count = 0
+        self._regions = {}
+        self._selector_regions = {}
+        self._sel = Selection([Region(0)])
+        self._settings = Settings({"syntax": syntax})
+        self._window = window
+        self._name = ""
+        self._scratch = False
+        self._read_only = False
+        self._closed = False
+        # (command name, args, repeat) of the commands which modified the buffer
+        self._history = []
+
+    # identity
+
+    def id(self):
+        return self._id
+
+    def buffer_id(self):
+        return self._buffer_id
+
+    def is_valid(self):
+        return not self._closed
+
+    def window(self):
+        return self._window
+
+    def file_name(self):
+        return self._file_name
+
+    def settings(self):
+        return self._settings
+
+    def set_name(self, name):
+        self._name = name
+
+    def set_scratch(self, scratch):
+        self._scratch = scratch
+
+    def set_read_only(self, read_only):
+        self._read_only = read_only
+
+    # text
+
+    def size(self):
+        return len(self._text)
+
+    def substr(self, x):
+        if isinstance(x, Region):
+            return self._text[x.begin() : x.end()]
+        return self._text[x : x + 1]
+
+    def change_count(self):
+        return self._change_count
+
+    def is_dirty(self):
+        return self._change_count != self._saved_change_count
+
+    def scope_name(self, point):
+        return self._scope + " "
+
+    def find_by_selector(self, selector):
+        return list(self._selector_regions.get(selector, []))
+
+    def set_selector_regions(self, selector, regions):
+        """ not part of sublime's API: what find_by_selector returns (there is
+        no syntax highlighting here). They aren't updated when the text changes """
+        self._selector_regions[selector] = list(regions)
+
+    def line(self, x):
+        region = x if isinstance(x, Region) else Region(x)
+        begin = self._text.rfind("\n", 0, region.begin()) + 1
+        end = self._text.find("\n", region.end())
+        if end == -1:
+            end = len(self._text)
+        return Region(begin, end)
+
+    def full_line(self, x):
+        line = self.line(x)
+        return Region(line.begin(), min(len(self._text), line.end() + 1))
+
+    def lines(self, region):
+        lines = []
+        point = region.begin()
+        while True:
+            line = self.line(point)
+            lines.append(line)
+            if line.end() >= region.end():
+                return lines
+            point = line.end() + 1
+
+    def sel(self):
+        self._flush()
+        return self._sel
+
+    # modifications (they need an edit, like in sublime)
+
+    def replace(self, edit, region, text):
+        assert isinstance(edit, Edit), "replace needs an edit"
+        self._modify(region.begin(), region.end(), text)
+
+    def insert(self, edit, point, text):
+        assert isinstance(edit, Edit), "insert needs an edit"
+        self._modify(point, point, text)
+        return len(text)
+
+    def erase(self, edit, region):
+        assert isinstance(edit, Edit), "erase needs an edit"
+        self._modify(region.begin(), region.end(), "")
+
+    def _paste(self, text):
+        """ replaces every selection with text, and leaves a cursor after each """
+        regions = list(self.sel())
+        for region in reversed(regions):
+            self._modify(region.begin(), region.end(), text)
+        self._flush()
+        cursors = []
+        shift = 0
+        for region in regions:
+            shift += len(text) - region.size()
+            cursors.append(Region(region.end() + shift))
+        self._sel = Selection(cursors)
+
+    def _modify(self, begin, end, text):
+        """ edits are applied lazily, on the next read. Copying the whole text and
+        moving every selection and region on each edit would make this (rather
+        than the plugin) the bottleneck of the benchmarks with many edits """
+        with self._lock:
+            self._change_count += 1
+            if self._pending and end > self._pending[-1][0]:
+                self._flush()
+            self._pending.append((begin, end, text))
+
+    def _flush(self):
+        """ applies the pending edits. Each one is before the previous one (like
+        the plugin's, which go from the end to the beginning), so their offsets
+        are all relative to _buffer, and they are applied in a single pass """
+        with self._lock:
+            if not self._pending:
+                return
+            edits = self._pending[::-1]
+            self._pending = []
+
+            parts = []
+            position = 0
+            for begin, end, text in edits:
+                parts.append(self._buffer[position:begin])
+                parts.append(text)
+                position = end
+            parts.append(self._buffer[position:])
+            self._buffer = "".join(parts)
+
+            ends = [end for _, end, _ in edits]
+            # shifts[i]: how much the text moved after the first i edits
+            shifts = [0]
+            for begin, end, text in edits:
+                shifts.append(shifts[-1] + len(text) - (end - begin))
+
+            def shift(point):
+                # the edits which end before point move it, and the point is moved
+                # at the end of the edit it's in (if any)
+                i = bisect.bisect_right(ends, point)
+                if i < len(edits) and edits[i][0] < point:
+                    return edits[i][0] + shifts[i] + len(edits[i][2])
+                return point + shifts[i]
+
+            for key, regions in self._regions.items():
+                self._regions[key] = [Region(shift(r.a), shift(r.b)) for r in regions]
+            self._sel._shift(shift)
+
+    @property
+    def _text(self):
+        self._flush()
+        return self._buffer
+
+    def command_history(self, index, modifying_only=False):
+        """ only the undo stack (index <= 0) of the modifying commands """
+        if index > 0 or -index >= len(self._history):
+            return ("", None, 0)
+        return self._history[index - 1]
+
+    def _insert(self, characters):
+        """ what typing does: inserts characters at every cursor """
+        regions = list(self.sel())
+        for region in reversed(regions):
+            self._modify(region.begin(), region.end(), characters)
+
+    # regions
+
+    def add_regions(self, key, regions, scope="", icon="", flags=0):
+        self._flush()
+        self._regions[key] = list(regions)
+
+    def get_regions(self, key):
+        self._flush()
+        return list(self._regions.get(key, []))
+
+    def erase_regions(self, key):
+        self._flush()
+        self._regions.pop(key, None)
+
+    # commands
+
+    def run_command(self, name, args=None):
+        _run_command(name, args, view=self)
+
+    def simulate_save(self):
+        """ what sublime does when saving: pre save, write, post save """
+        _dispatch("on_pre_save", self)
+        self._saved_change_count = self._change_count
+        _dispatch("on_post_save", self)
+        _dispatch("on_post_save_async", self)
+
+    def simulate_close(self):
+        _dispatch("on_close", self)
+        self._closed = True
+
+
+def _command_name(cls):
+    name = cls.__name__
+    if name.endswith("Command"):
+        name = name[: -len("Command")]
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", name).lower()
+
+
+def _run_command(name, args, *, view=None, window=None):
+    import sublime_plugin
+
+    args = args or {}
+    if view is not None:
+        for cls in sublime_plugin.TextCommand.__subclasses__():
+            if _command_name(cls) == name:
+                command = cls(view)
+                _run_text_command(view, name, args, lambda: command.run(Edit(), **args))
+                return
+        if name == "paste":
+            _run_text_command(view, name, args, lambda: view._paste(_clipboard))
+            return
+        if name == "insert":
+            _run_text_command(
+                view, name, args, lambda: view._insert(args.get("characters", ""))
+            )
+            return
+        if name == "append":
+            view._modify(view.size(), view.size(), args.get("characters", ""))
+            return
+        if name == "save":
+            view.simulate_save()
+            return
+        window = view.window()
+
+    for cls in sublime_plugin.WindowCommand.__subclasses__():
+        if _command_name(cls) == name:
+            cls(window or Window()).run(**args)
+            return
+
+
+def _run_text_command(view, name, args, run):
+    """ like sublime, on_modified is only called if run modified the buffer """
+    _dispatch("on_text_command", view, name, args)
+    change_count = view.change_count()
+    run()
+    if view.change_count() != change_count:
+        view._history.append((name, args, 1))
+        _dispatch("on_modified", view)
+        _dispatch("on_modified_async", view)
+    _dispatch("on_post_text_command", view, name, args)
+
+
+_listeners = {}
+
+
+def _dispatch(event, view, *args):
+    """ calls the event on the view listeners that apply to the view """
+    import sublime_plugin
+
+    for cls in sublime_plugin.ViewEventListener.__subclasses__():
+        if not cls.is_applicable(view.settings()):
+            continue
+        key = (cls, view.id())
+        if key not in _listeners:
+            _listeners[key] = cls(view)
+        method = getattr(_listeners[key], event, None)
+        if method is None:
+            continue
+        if event.endswith("_async"):
+            set_timeout_async(lambda method=method: method(*args))
+        else:
+            method(*args)
+
+
+# module level API
+
+
+def load_settings(name):
+    if name not in _settings:
+        _settings[name] = Settings()
+    return _settings[name]
+
+
+def save_settings(name):
+    pass
+
+
+def set_timeout(callback, delay=0):
+    threading.Timer(delay / 1000, callback).start()
+
+
+def set_timeout_async(callback, delay=0):
+    """ like sublime, every callback (and every *_async event) runs on the same
+    thread, one after the other. A callback waiting for another one to run
+    blocks forever, just like in the editor """
+    global _async_thread
+    with _async_condition:
+        when = time.monotonic() + delay / 1000
+        heapq.heappush(_async_queue, (when, next(_async_sequence), callback))
+        if _async_thread is None:
+            _async_thread = threading.Thread(target=_run_async, daemon=True)
+            _async_thread.start()
+        _async_condition.notify()
+
+
+def _run_async():
+    while True:
+        with _async_condition:
+            while True:
+                if not _async_queue:
+                    _async_condition.wait()
+                    continue
+                delay = _async_queue[0][0] - time.monotonic()
+                if delay <= 0:
+                    _, _, callback = heapq.heappop(_async_queue)
+                    break
+                _async_condition.wait(delay)
+        try:
+            callback()
+        except Exception:
+            traceback.print_exc()
+
+
+def wait_for_async(timeout=None):
+    """ returns True once every callback queued so far ran, False if that takes
+    more than timeout seconds (eg. the async thread is stuck) """
+    done = threading.Event()
+    set_timeout_async(done.set)
+    return done.wait(timeout)
+
+
+def windows():
+    return list(_windows)
+
+
+def set_clipboard(text):
+    global _clipboard
+    _clipboard = text
+
+
+def get_clipboard(size_limit=16777216):
+    return _clipboard
+
+
+def status_message(message):
+    _messages.append(message)
+
+
+def error_message(message):
+    _messages.append(message)
+
+
+def ok_cancel_dialog(message, ok_title=""):
+    return False
+
+
+def platform():
+    return _platform
+
+
+def arch():
+    return "x64"
+
+
+def cache_path():
+    return _cache_path
+
+
+def load_resource(name):
+    return _resources[name]
+
+
+def find_resources(pattern):
+    import fnmatch
+
+    return [
+        name
+        for name in _resources
+        if fnmatch.fnmatch(os.path.basename(name), pattern)
+    ]
+
+
+def add_resource(name, content):
+    """ not part of sublime's API: registers a resource for load_resource """
+    _resources[name] = content
+
+
+def load_default_settings(name, path):
+    """ not part of sublime's API: loads a .sublime-settings file (they can
+    contain comments) as the settings called name """
+    with open(path) as fp:
+        lines = [line for line in fp if not line.strip().startswith("//")]
+    load_settings(name)._values.update(json.loads("".join(lines)))
+
+
+def _make_sublime_plugin():
+    module = types.ModuleType("sublime_plugin")
+
+    class ViewEventListener:
+        @classmethod
+        def is_applicable(cls, settings):
+            return True
+
+        @classmethod
+        def applies_to_primary_view_only(cls):
+            return True
+
+        def __init__(self, view):
+            self.view = view
+
+    class EventListener:
+        pass
+
+    class TextCommand:
+        def __init__(self, view):
+            self.view = view
+
+    class WindowCommand:
+        def __init__(self, window):
+            self.window = window
+
+    class ApplicationCommand:
+        pass
+
+    module.ViewEventListener = ViewEventListener
+    module.EventListener = EventListener
+    module.TextCommand = TextCommand
+    module.WindowCommand = WindowCommand
+    module.ApplicationCommand = ApplicationCommand
+    return module
+
+
+def install():
+    """ makes `import sublime` and `import sublime_plugin` use the fakes """
+    sys.modules["sublime"] = sys.modules[__name__]
+    sys.modules["sublime_plugin"] = _make_sublime_plugin()
@@ -0,0 +1,119 @@
+""" Loads the plugin outside of sublime text, against the stub server """
+
+import importlib
+import os
+import socket
+import stat
+import sys
+import tempfile
+import time
+import types
+
+import fake_sublime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = "JSONComma"
+SETTINGS = "JSONComma.sublime-settings"
+
+
+def load_plugin():
+    """ imports the plugin (as sublime would, as the JSONComma package) with
+    the fake sublime modules, and returns its main module """
+    fake_sublime.install()
+    if PACKAGE not in sys.modules:
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = [ROOT]
+        sys.modules[PACKAGE] = package
+
+    fake_sublime.load_default_settings(SETTINGS, os.path.join(ROOT, SETTINGS))
+    return importlib.import_module(PACKAGE + ".jsoncomma")
+
+
+def load_like_sublime():
+    """ imports every module at the root of the package (in order, like sublime
+    does when it starts) and calls plugin_loaded. Meant to run in a fresh
+    interpreter, see bench_startup. Returns the durations (in seconds) and the
+    modules the plugin imported """
+    fake_sublime.install()
+    fake_sublime.load_default_settings(SETTINGS, os.path.join(ROOT, SETTINGS))
+    package = types.ModuleType(PACKAGE)
+    package.__path__ = [ROOT]
+    sys.modules[PACKAGE] = package
+    before = set(sys.modules)
+
+    started_at = time.perf_counter()
+    modules = [
+        importlib.import_module("{}.{}".format(PACKAGE, name[: -len(".py")]))
+        for name in sorted(os.listdir(ROOT))
+        if name.endswith(".py")
+    ]
+    imported_at = time.perf_counter()
+    for module in modules:
+        if hasattr(module, "plugin_loaded"):
+            module.plugin_loaded()
+    loaded_at = time.perf_counter()
+
+    return {
+        "import": imported_at - started_at,
+        "plugin_loaded": loaded_at - imported_at,
+        "modules": sorted(set(sys.modules) - before),
+    }
+
+
+def stub_executable(*, echo=False):
+    """ writes a script which runs the stub server, so that the plugin can start
+    it like it would start the jsoncomma binary. Returns its path """
+    directory = tempfile.mkdtemp(prefix="jsoncomma-stub-")
+    path = os.path.join(directory, "jsoncomma")
+    with open(path, "w") as fp:
+        fp.write(
+            '#!/bin/sh\nexec "{}" "{}" {} "$@"\n'.format(
+                sys.executable,
+                os.path.join(ROOT, "bench", "stub_server.py"),
+                "-echo" if echo else "",
+            )
+        )
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def configure(**settings):
+    """ sets the plugin's settings (the defaults are loaded by load_plugin) """
+    values = fake_sublime.load_settings(SETTINGS)
+    for key, value in settings.items():
+        values.set(key, value)
+
+
+def use_stub_server(plugin, *, echo=False, transport="tcp", executable=None):
+    """ points the plugin at a stub server binary (or at executable, a real
+    jsoncomma binary) on a free port (it isn't started). Returns the plugin's
+    server class """
+    server = sys.modules[PACKAGE + ".server"].server
+    server.PORT = free_port()
+    # keep the lock file and the server record away from the real jsoncomma's
+    data_path = tempfile.mkdtemp(prefix="jsoncomma-data-")
+    server.get_data_path = classmethod(lambda cls: data_path)
+    configure(
+        automatically_update_executable=False,
+        executable_path=executable or stub_executable(echo=echo),
+        socket_path=os.path.join(tempfile.mkdtemp(prefix="jsoncomma-"), "stub.sock"),
+    )
+    use_transport(server, transport)
+    return server
+
+
+def use_transport(server, transport):
+    """ switches the transport, restarting the server if it's running """
+    running = server.state == "ready"
+    if running:
+        server.stop()
+    configure(transport=transport)
+    server.reload_transport()
+    if running:
+        server.start()
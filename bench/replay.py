@@ -0,0 +1,226 @@
+""" Replays a trace of fix requests (see the trace_requests setting) against a
+jsoncomma server, to reproduce real save patterns offline.
+
+The requests are sent at the pace they were recorded at (or --speed times
+faster, 0 sends them as fast as possible), by --concurrency connections. By
+default, only the requests which went to the server are replayed (not the ones
+fixed in process or answered from the cache), see --all.
+
+Payloads which were recorded in full (trace_sample_size: -1) are sent as is,
+the others are replaced with made up JSON of the same size.
+
+    python bench/replay.py trace.jsonl                    # against the stub
+    python bench/replay.py trace.jsonl --speed 10 --concurrency 8
+    python bench/replay.py trace.jsonl --port 2442        # a running server
+
+Prints a JSON object with the throughput, the latency percentiles and the error
+rate. When the requests are paced, latencies are measured from when the request
+should have been sent, so that a server falling behind shows up in the tail
+(otherwise, from when it was actually sent).
+"""
+
+import argparse
+import concurrent.futures
+import http.client
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from run import make_json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the request sources (see tracing.py) which reached the server
+SERVER_SOURCES = ("server", "error")
+
+TIMEOUT = 30
+
+
+def read_trace(paths, *, everything):
+    entries = []
+    for path in paths:
+        with open(path, encoding="utf-8") as fp:
+            for line in fp:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if everything or entry["source"] in SERVER_SOURCES:
+                    entries.append(entry)
+    entries.sort(key=lambda entry: entry["at"])
+    return entries
+
+
+def payloads(entries):
+    """ the bytes to send for every entry. Entries with the same hash get the
+    same payload """
+    made_up = {}
+    for entry in entries:
+        if "payload" in entry:
+            yield entry["payload"].encode("utf-8")
+            continue
+        key = entry["sha1"]
+        if key not in made_up:
+            made_up[key] = make_json(entry["size"], seed=len(made_up)).encode("utf-8")
+        yield made_up[key]
+
+
+def start_stub(*, echo):
+    """ starts bench/stub_server.py on a free port, returns (process, port) """
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(ROOT, "bench", "stub_server.py"),
+            "server",
+            "-port",
+            "0",
+        ]
+        + (["-echo"] if echo else []),
+        stdout=subprocess.PIPE,
+    )
+    infos = json.loads(process.stdout.readline().decode("utf-8"))
+    assert infos["kind"] == "started", "stub didn't start: {}".format(infos)
+    return process, infos["port"]
+
+
+class Client:
+    """ one keep-alive connection per thread """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.local = threading.local()
+
+    def fix(self, payload):
+        """ returns whether the server answered properly """
+        for attempt in range(2):
+            conn = getattr(self.local, "conn", None)
+            if conn is None:
+                conn = self.local.conn = http.client.HTTPConnection(
+                    self.host, self.port, timeout=TIMEOUT
+                )
+            try:
+                conn.request("POST", "/", payload)
+                resp = conn.getresponse()
+                resp.read()
+                return resp.status == 200
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                self.local.conn = None
+                if attempt == 1:
+                    return False
+
+
+def replay(entries, client, *, speed, concurrency):
+    """ returns [(latency in seconds, ok, size)] and the total duration """
+    results = []
+    results_lock = threading.Lock()
+
+    def send(payload, scheduled_at):
+        if scheduled_at is None:
+            scheduled_at = time.perf_counter()
+        ok = client.fix(payload)
+        latency = time.perf_counter() - scheduled_at
+        with results_lock:
+            results.append((latency, ok, len(payload)))
+
+    first = entries[0]["at"] if entries else 0
+    started_at = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for entry, payload in zip(entries, payloads(entries)):
+            scheduled_at = None
+            if speed > 0:
+                scheduled_at = started_at + (entry["at"] - first) / speed
+                delay = scheduled_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(send, payload, scheduled_at)
+    return results, time.perf_counter() - started_at
+
+
+def percentile(sorted_values, percent):
+    """ nearest-rank percentile of an already sorted list """
+    index = max(0, -(-len(sorted_values) * percent // 100) - 1)
+    return sorted_values[int(index)]
+
+
+def report(results, duration):
+    latencies = sorted(latency for latency, _, _ in results)
+    errors = sum(1 for _, ok, _ in results if not ok)
+    size = sum(size for _, _, size in results)
+    infos = {
+        "requests": len(results),
+        "errors": errors,
+        "error_rate": errors / len(results) if results else 0,
+        "duration_s": duration,
+        "requests_per_second": len(results) / duration if duration else None,
+        "mb_per_second": size / duration / 1e6 if duration else None,
+    }
+    if latencies:
+        for percent in (50, 95, 99):
+            infos["p{}_ms".format(percent)] = percentile(latencies, percent) * 1000
+        infos["max_ms"] = latencies[-1] * 1000
+    return infos
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("trace", nargs="+", help="trace files (jsonl)")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1,
+        help="replay this many times faster than recorded (0: as fast as possible)",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="connections to the server"
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="also replay the requests which didn't reach the server",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument(
+        "--port", type=int, help="a running server's port (default: start the stub)"
+    )
+    parser.add_argument(
+        "--echo", action="store_true", help="the stub server doesn't fix anything"
+    )
+    args = parser.parse_args()
+
+    entries = read_trace(args.trace, everything=args.all)
+    if not entries:
+        sys.exit("nothing to replay in {}".format(", ".join(args.trace)))
+
+    process, port = None, args.port
+    if port is None:
+        process, port = start_stub(echo=args.echo)
+    try:
+        results, duration = replay(
+            entries,
+            Client(args.host, port),
+            speed=args.speed,
+            concurrency=args.concurrency,
+        )
+    finally:
+        if process is not None:
+            try:
+                conn = http.client.HTTPConnection(args.host, port, timeout=TIMEOUT)
+                conn.request("GET", "/shutdown")
+                conn.getresponse().read()
+            except (OSError, http.client.HTTPException):
+                process.kill()
+            process.wait()
+
+    infos = report(results, duration)
+    infos.update(speed=args.speed, concurrency=args.concurrency)
+    print(json.dumps(infos))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,532 @@
+""" Headless benchmarks for the plugin.
+
+Runs outside of sublime text (see fake_sublime.py) against a local stub of the
+jsoncomma server (see stub_server.py), and prints one JSON object per line, so
+that results can be compared between commits:
+
+    python bench/run.py --output before.jsonl
+    python bench/run.py --quick
+"""
+
+import argparse
+import importlib
+import json
+import platform
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_sublime
+import harness
+
+SIZES = [1024, 64 * 1024, 1024 * 1024, 10 * 1024 * 1024, 50 * 1024 * 1024]
+QUICK_SIZES = [1024, 64 * 1024, 1024 * 1024]
+REGION_COUNTS = [1, 10, 100, 1000]
+# where fixing in process stops being faster than asking the server (see
+# local_fix_threshold)
+CROSSOVER_SIZES = [64, 128, 256, 512, 1024, 2048, 4096, 16 * 1024, 64 * 1024]
+TRANSPORTS = ["tcp", "unix", "stdio"]
+# slow to import, the plugin shouldn't import them when it's loaded
+HEAVY_MODULES = [
+    "requests",
+    "http.client",
+    "tarfile",
+    "subprocess",
+    "concurrent.futures",
+]
+
+
+def make_json(size, *, seed=0):
+    """ JSON-like text of about size characters, with missing and trailing
+    commas for the server to fix """
+    rng = random.Random(seed)
+    lines = ["["]
+    total = 2
+    i = 0
+    while total < size:
+        line = '    {{"id": {} "name": "item {}", "tags": ["a" "b",], "ok": {}}}'.format(
+            i, rng.randint(0, 1 << 30), "true" if i % 2 else "false"
+        )
+        lines.append(line)
+        total += len(line) + 1
+        i += 1
+    lines.append("]")
+    return "\n".join(lines)
+
+
+def measure(function, *, min_iterations=3, min_time=1.0, max_iterations=1000):
+    """ calls function until it ran at least min_iterations times and for at
+    least min_time seconds. Returns the durations (in seconds) """
+    durations = []
+    started_at = time.perf_counter()
+    while len(durations) < max_iterations and (
+        len(durations) < min_iterations or time.perf_counter() - started_at < min_time
+    ):
+        durations.append(function())
+    return durations
+
+
+def result(benchmark, durations, **params):
+    durations = sorted(durations)
+    infos = {
+        "benchmark": benchmark,
+        "iterations": len(durations),
+        "min_ms": durations[0] * 1000,
+        "median_ms": statistics.median(durations) * 1000,
+        "mean_ms": statistics.mean(durations) * 1000,
+        "max_ms": durations[-1] * 1000,
+    }
+    if "size" in params:
+        infos["mb_per_second"] = params["size"] / statistics.median(durations) / 1e6
+    infos.update(params)
+    return infos
+
+
+def bench_fix_command(plugin, server, size):
+    text = make_json(size)
+
+    def run():
+        view = fake_sublime.View(text)
+        command = plugin.JsoncommaFixCommand(view)
+        # we want to measure the round trip, not the cache
+        server.cache.clear()
+        started_at = time.perf_counter()
+        command.run(fake_sublime.Edit(), ranges=[(0, view.size())])
+        duration = time.perf_counter() - started_at
+        assert plugin.JsoncommaFixCommand.succeeded[view.id()], "fix failed"
+        return duration
+
+    return result("fix_command", measure(run, min_iterations=1), size=len(text))
+
+
+def bench_regions(plugin, server, count):
+    objects = [make_json(512, seed=i) for i in range(count)]
+    text = "\n".join(objects)
+
+    def run():
+        view = fake_sublime.View(text)
+        view.sel().clear()
+        offset = 0
+        for obj in objects:
+            view.sel().add(fake_sublime.Region(offset, offset + len(obj)))
+            offset += len(obj) + 1
+        command = plugin.JsoncommaFixCommand(view)
+        server.cache.clear()
+        started_at = time.perf_counter()
+        command.run(fake_sublime.Edit())
+        return time.perf_counter() - started_at
+
+    return result(
+        "fix_regions", measure(run, min_iterations=1), regions=count, size=len(text)
+    )
+
+
+def bench_crossover(server, sizes):
+    """ fixer.fix against a round trip to the server, for each size. Only
+    meaningful with --executable: the stub fixes with fixer.fix itself """
+    fixer = importlib.import_module(harness.PACKAGE + ".fixer")
+    settings = fake_sublime.load_settings(harness.SETTINGS)
+    results = []
+    crossover = None
+    for size in sizes:
+        text = make_json(size, seed=size)
+
+        def local():
+            started_at = time.perf_counter()
+            fixer.fix(text)
+            return time.perf_counter() - started_at
+
+        def remote():
+            server.cache.clear()
+            started_at = time.perf_counter()
+            _, source = server._fix(text, settings)
+            duration = time.perf_counter() - started_at
+            assert source == "server", "fixed by {}, not the server".format(source)
+            return duration
+
+        local_infos = result("crossover", measure(local), size=len(text))
+        remote_infos = result("crossover", measure(remote), size=len(text))
+        local_infos["fixer"] = "local"
+        remote_infos["fixer"] = "server"
+        results += [local_infos, remote_infos]
+        if crossover is None and remote_infos["median_ms"] < local_infos["median_ms"]:
+            crossover = len(text)
+
+    results.append({"benchmark": "crossover", "crossover_size": crossover})
+    return results
+
+
+def bench_cold_start(server):
+    def run():
+        server.stop()
+        started_at = time.perf_counter()
+        server.start()
+        duration = time.perf_counter() - started_at
+        assert server.state == "ready", "server is {}".format(server.state)
+        return duration
+
+    durations = measure(run, min_iterations=5, min_time=0, max_iterations=5)
+    return result("cold_start", durations)
+
+
+def bench_transport(server, transport, *, quick):
+    """ the same requests over each transport: latency for small payloads,
+    throughput for large ones (sent whole, and streamed) """
+    harness.use_transport(server, transport)
+    if server.state != "ready":
+        server.start()
+
+    small = make_json(1024)
+    large = make_json(1024 * 1024 if quick else 8 * 1024 * 1024)
+    results = []
+
+    def run_small():
+        calls = 100
+        started_at = time.perf_counter()
+        for _ in range(calls):
+            server.cache.clear()
+            assert server.fix(small) is not None, "fix failed"
+        return (time.perf_counter() - started_at) / calls
+
+    results.append(
+        result("transport", measure(run_small), transport=transport, size=len(small))
+    )
+
+    def run_large():
+        server.cache.clear()
+        started_at = time.perf_counter()
+        assert server.fix(large) is not None, "fix failed"
+        return time.perf_counter() - started_at
+
+    results.append(
+        result(
+            "transport",
+            measure(run_large, min_iterations=1),
+            transport=transport,
+            size=len(large),
+        )
+    )
+
+    def run_stream():
+        def read_chunks():
+            for i in range(0, len(large), 256 * 1024):
+                yield large[i : i + 256 * 1024]
+
+        started_at = time.perf_counter()
+        chunks = server.fix_chunks(read_chunks, len(large))
+        assert chunks is not None, "fix failed"
+        for _ in chunks:
+            pass
+        return time.perf_counter() - started_at
+
+    results.append(
+        result(
+            "transport",
+            measure(run_stream, min_iterations=1),
+            transport=transport,
+            size=len(large),
+            streamed=True,
+        )
+    )
+    return results
+
+
+def bench_fix_folder(server, count):
+    """ fix_files on a folder of count small files (they are all changed). One
+    in ten starts with a byte order mark, which must be kept as is """
+    bulk = sys.modules[harness.PACKAGE + ".bulk"]
+    folder = tempfile.mkdtemp(prefix="jsoncomma-bench-")
+    contents = [make_json(2048, seed=i) for i in range(count)]
+    bom = "\ufeff"
+
+    def run():
+        for i, content in enumerate(contents):
+            path = os.path.join(folder, "{}.json".format(i))
+            with open(path, "w", encoding="utf-8") as fp:
+                fp.write(bom + content if i % 10 == 0 else content)
+        server.cache.clear()
+        bulk.known_fixed.clear()
+        started_at = time.perf_counter()
+        bulk.fix_files("bench", [folder])
+        # fix_files starts the batch from a background thread
+        while bulk.current is None or bulk.current.label != "bench":
+            time.sleep(0.001)
+        bulk.current.wait()
+        duration = time.perf_counter() - started_at
+        assert bulk.current.counts[bulk.CHANGED] == count, bulk.current.counts
+        bulk.current = None
+        for i in range(0, count, 10):
+            with open(os.path.join(folder, "{}.json".format(i)), "rb") as fp:
+                start = fp.read(4)
+            assert start == bom.encode("utf-8") + b"[", "{}.json: {!r}".format(i, start)
+        return duration
+
+    try:
+        durations = measure(run, min_iterations=1)
+    finally:
+        shutil.rmtree(folder)
+    infos = result("fix_folder", durations, files=count)
+    infos["files_per_second"] = count / statistics.median(durations)
+    return infos
+
+
+def bench_embedded(plugin, server, size):
+    """ fixing a markdown document of about size characters with a few JSON code
+    blocks: only the blocks are sent """
+    selector = "markup.raw.code-fence source.json"
+    syntax = "Packages/Markdown/Markdown.sublime-syntax"
+    fake_sublime.add_resource(syntax, "%YAML 1.2\n---\nname: Markdown\n")
+    harness.configure(fix_embedded_json=True, embedded_json_selectors=[selector])
+    prose = "Some *markdown* text, which isn't JSON at all [1 2].\n" * (size // 52)
+    snippets = [make_json(1024, seed=i) for i in range(5)]
+    parts, islands = [], []
+    offset = 0
+    for snippet in snippets:
+        parts.append(prose[: len(prose) // len(snippets)] + "```json\n")
+        offset += len(parts[-1])
+        parts.append(snippet)
+        islands.append(fake_sublime.Region(offset, offset + len(snippet)))
+        offset += len(snippet)
+        parts.append("\n```\n")
+        offset += len(parts[-1])
+    text = "".join(parts)
+
+    def run():
+        view = fake_sublime.View(text, syntax=syntax, scope="text.html.markdown")
+        view.set_selector_regions(selector, islands)
+        listener = plugin.JsonCommaListener(view)
+        server.cache.clear()
+        started_at = time.perf_counter()
+        job = listener.prefix(now=True)
+        duration = time.perf_counter() - started_at
+        assert job.fixes is not None and len(job.fixes) == len(islands), "fix failed"
+        return duration
+
+    try:
+        infos = result("embedded", measure(run), size=len(text))
+    finally:
+        harness.configure(fix_embedded_json=False)
+    infos["sent"] = sum(len(snippet) for snippet in snippets)
+    return infos
+
+
+def bench_startup():
+    """ importing the plugin and plugin_loaded, in a fresh interpreter every time
+    (that's what every editor start and plugin reload pays) """
+    code = "import json, harness; print(json.dumps(harness.load_like_sublime()))"
+    runs = []
+
+    def run():
+        output = subprocess.check_output(
+            [sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        runs.append(json.loads(output.decode("utf-8").splitlines()[-1]))
+        return runs[-1]["import"]
+
+    infos = result("startup", measure(run, max_iterations=20))
+    infos["plugin_loaded_ms"] = (
+        statistics.median(entry["plugin_loaded"] for entry in runs) * 1000
+    )
+    infos["heavy_modules"] = [
+        name for name in HEAVY_MODULES if name in runs[-1]["modules"]
+    ]
+    return infos
+
+
+def bench_paste(plugin, server, size, *, fix_on_paste):
+    """ pasting an array with broken commas into a large document (which was
+    fixed), and then saving it. With fix_on_paste, the pasted text is fixed right
+    away (that's reported separately), and the save fixes the lines around it """
+    harness.configure(fix_on_paste=fix_on_paste)
+    fixed_text = server.fix(make_json(size))
+    pasted = make_json(4 * 1024, seed=1) + "\n"
+    fake_sublime.set_clipboard(pasted)
+    fixed_after = []
+
+    def saved(view):
+        # a save that takes too long is fixed right after it, in the background
+        assert fake_sublime.wait_for_async(10), "the async thread is stuck"
+        deadline = time.perf_counter() + 10
+        while not plugin.JsoncommaFixCommand.is_fixed(view):
+            assert time.perf_counter() < deadline, "not fixed on save"
+            time.sleep(0.001)
+
+    def run():
+        view = fake_sublime.View(fixed_text)
+        server.cache.clear()
+        view.simulate_save()
+        saved(view)
+        view.sel().clear()
+        view.sel().add(fake_sublime.Region(len("[\n")))
+
+        started_at = time.perf_counter()
+        view.run_command("paste")
+        if fix_on_paste:
+            pasted_change_count = view.change_count()
+            while view.change_count() == pasted_change_count:
+                time.sleep(0.001)
+            fixed_after.append(time.perf_counter() - started_at)
+        assert fake_sublime.wait_for_async(10), "the async thread is stuck"
+
+        started_at = time.perf_counter()
+        view.simulate_save()
+        duration = time.perf_counter() - started_at
+        saved(view)
+        return duration
+
+    try:
+        infos = result("paste_then_save", measure(run), size=len(fixed_text))
+    finally:
+        harness.configure(fix_on_paste=False)
+    infos["fix_on_paste"] = fix_on_paste
+    if fixed_after:
+        # from the paste to the fix being applied, and what it sent to the server
+        infos["fixed_after_paste_ms"] = statistics.median(fixed_after) * 1000
+        infos["paste_sent"] = len(pasted)
+    return infos
+
+
+def bench_should_be_enabled(plugin):
+    fake_sublime.add_resource(
+        "Packages/Bench/Bench.sublime-syntax", "%YAML 1.2\n---\nname: Bench\n"
+    )
+    cases = [
+        ("json", "settings.json", "Packages/JSON/JSON.sublime-syntax", "source.json"),
+        (
+            "other",
+            "notes.txt",
+            "Packages/Bench/Bench.sublime-syntax",
+            "text.plain",
+        ),
+    ]
+    results = []
+    for name, filename, syntax, scope in cases:
+        calls = 10000
+
+        def run():
+            started_at = time.perf_counter()
+            for _ in range(calls):
+                plugin.should_be_enabled(filename=filename, syntax=syntax, scope=scope)
+            return (time.perf_counter() - started_at) / calls
+
+        results.append(result("should_be_enabled", measure(run), case=name))
+    return results
+
+
+def git_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], cwd=harness.ROOT, stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--quick", action="store_true", help="skip the large sizes")
+    parser.add_argument("--output", help="file to write the results to (jsonl)")
+    parser.add_argument(
+        "--echo",
+        action="store_true",
+        help="the stub server doesn't fix anything (measures the plugin's overhead)",
+    )
+    parser.add_argument(
+        "--only", action="append", help="only run these benchmarks (repeatable)"
+    )
+    parser.add_argument(
+        "--executable",
+        help="run the benchmarks against this jsoncomma binary instead of the stub",
+    )
+    parser.add_argument(
+        "--transport",
+        choices=TRANSPORTS,
+        default="tcp",
+        help="the transport used by the other benchmarks than 'transport'",
+    )
+    args = parser.parse_args()
+
+    plugin = harness.load_plugin()
+    server = harness.use_stub_server(
+        plugin, echo=args.echo, transport=args.transport, executable=args.executable
+    )
+    # always go through the server, that's what we want to measure
+    harness.configure(local_fix_threshold=0, prefix_delay_ms=-1)
+
+    output = open(args.output, "w") if args.output else sys.stdout
+
+    def emit(infos):
+        infos["commit"] = commit
+        infos["python"] = platform.python_version()
+        infos["echo"] = args.echo
+        infos["executable"] = args.executable or "stub"
+        infos.setdefault("transport", args.transport)
+        output.write(json.dumps(infos) + "\n")
+        output.flush()
+
+    def enabled(name):
+        return not args.only or name in args.only
+
+    commit = git_commit()
+    try:
+        if enabled("startup"):
+            emit(bench_startup())
+
+        if enabled("cold_start"):
+            emit(bench_cold_start(server))
+
+        if server.state != "ready":
+            server.start()
+
+        if enabled("fix_command"):
+            for size in QUICK_SIZES if args.quick else SIZES:
+                emit(bench_fix_command(plugin, server, size))
+
+        if enabled("fix_regions"):
+            for count in REGION_COUNTS:
+                emit(bench_regions(plugin, server, count))
+
+        if enabled("embedded"):
+            emit(bench_embedded(plugin, server, 1024 * 1024))
+
+        if enabled("paste"):
+            for fix_on_paste in (False, True):
+                emit(
+                    bench_paste(plugin, server, 1024 * 1024, fix_on_paste=fix_on_paste)
+                )
+
+        if enabled("fix_folder"):
+            emit(bench_fix_folder(server, 200 if args.quick else 1000))
+
+        if enabled("should_be_enabled"):
+            for infos in bench_should_be_enabled(plugin):
+                emit(infos)
+
+        if enabled("crossover"):
+            for infos in bench_crossover(server, CROSSOVER_SIZES):
+                emit(infos)
+
+        if enabled("transport"):
+            for transport in TRANSPORTS:
+                if transport == "unix" and not hasattr(socket, "AF_UNIX"):
+                    continue
+                for infos in bench_transport(server, transport, quick=args.quick):
+                    emit(infos)
+    finally:
+        server.stop()
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+""" A local stand-in for the jsoncomma binary.
+
+It speaks the same protocol as `jsoncomma server`: the first line on stdout is
+a JSON object describing whether the server started (or why it couldn't), POST /
+fixes the body, and GET /shutdown replies with a JSON line before stopping.
+The commas are fixed with the plugin's own in-process fixer.
+
+It can also listen on a unix domain socket (-socket), or talk length prefixed
+frames over its stdin/stdout (-stdio), see transport.py for the protocol.
+
+    python stub_server.py server -host 127.0.0.1 -port 2442 [-echo]
+    python stub_server.py server -socket /tmp/jsoncomma.sock [-echo]
+    python stub_server.py server -stdio [-echo]
+    python stub_server.py -version
+"""
+
+import argparse
+import http.server
+import json
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixer  # noqa: E402
+
+VERSION = "0.0.0-stub"
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # send the headers and the body in one go (otherwise Nagle's algorithm and
+    # delayed ACKs add ~40ms to every response)
+    wbufsize = -1
+
+    def do_POST(self):
+        body = self.read_body()
+        if has_bom(body):
+            self.send_error(400, BOM_ERROR)
+            return
+        fixed = fix(body, echo=self.server.echo)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(fixed)))
+        self.end_headers()
+        self.wfile.write(fixed)
+
+    def do_GET(self):
+        if self.path != "/shutdown":
+            self.send_error(404)
+            return
+
+        # like jsoncomma, only reply once the server stopped listening, so that
+        # the port is free when the client gets the response
+        self.server.shutdown()
+        self.server.server_close()
+
+        body = (json.dumps({"timedout": False}) + "\n").encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+        self.server.done.set()
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b"".join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def log_message(self, format, *args):
+        pass
+
+
+BOM_ERROR = "byte order mark in the request"
+
+
+def has_bom(body):
+    # a byte order mark isn't JSON: the plugin must strip it before sending the
+    # text (fixer.py skips it, so the stub would hide the bug otherwise)
+    return body.startswith(b"\xef\xbb\xbf")
+
+
+def fix(body, *, echo):
+    # echo replies with the request's body as is, to measure the plugin's overhead
+    # rather than the stub's
+    if echo:
+        return body
+    return fixer.fix(body.decode("utf-8")).encode("utf-8")
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, echo=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.echo = echo
+        # set once the reply to /shutdown is sent
+        self.done = threading.Event()
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, *args, echo=False, **kwargs):
+        remove_stale_socket(path)
+        super().__init__(path, *args, **kwargs)
+        self.echo = echo
+        self.done = threading.Event()
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+def remove_stale_socket(path):
+    """ removes the socket file left behind by a server which crashed. A live
+    server's socket is left alone (binding to it fails, like the port would) """
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+FRAME_HEADER = struct.Struct(">I")
+
+
+def serve_stdio(*, echo):
+    """ answers framed requests on stdin until it's closed (or /shutdown) """
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+
+    def read_frame():
+        header = stdin.read(FRAME_HEADER.size)
+        if len(header) != FRAME_HEADER.size:
+            return None
+        return stdin.read(FRAME_HEADER.unpack(header)[0])
+
+    def write_message(header, body):
+        frames = [header, body, b""] if body else [header, b""]
+        for frame in frames:
+            stdout.write(FRAME_HEADER.pack(len(frame)))
+            stdout.write(frame)
+        stdout.flush()
+
+    while True:
+        header = read_frame()
+        if header is None:
+            return
+        body = []
+        while True:
+            frame = read_frame()
+            if frame is None:
+                return
+            if not frame:
+                break
+            body.append(frame)
+
+        if header == b"GET /shutdown":
+            write_message(
+                b"200 application/json",
+                (json.dumps({"timedout": False}) + "\n").encode("utf-8"),
+            )
+            return
+        body = b"".join(body)
+        if has_bom(body):
+            write_message(b"400 text/plain", BOM_ERROR.encode("utf-8"))
+            continue
+        write_message(b"200 text/plain; charset=utf-8", fix(body, echo=echo))
+
+
+def serve(host, port, *, echo=False):
+    """ starts the stub in a background thread, returns the server """
+    server = Server((host, port), Handler, echo=echo)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-version", action="store_true")
+    parser.add_argument("command", nargs="?")
+    parser.add_argument("-host", default="127.0.0.1")
+    parser.add_argument("-port", type=int, default=2442)
+    parser.add_argument("-socket", help="listen on this unix domain socket")
+    parser.add_argument("-stdio", action="store_true", help="talk over stdin/stdout")
+    parser.add_argument("-echo", action="store_true", help="don't fix anything")
+    args = parser.parse_args()
+
+    if args.version:
+        print("{} (stub)".format(VERSION))
+        return
+
+    assert args.command == "server", "only 'server' is supported"
+
+    if args.stdio:
+        print(json.dumps({"kind": "started", "addr": "stdio"}), flush=True)
+        serve_stdio(echo=args.echo)
+        return
+
+    try:
+        if args.socket:
+            server = UnixServer(args.socket, Handler, echo=args.echo)
+        else:
+            server = Server((args.host, args.port), Handler, echo=args.echo)
+    except OSError as e:
+        print(
+            json.dumps(
+                {
+                    "kind": "error",
+                    "error": str(e),
+                    "details": repr(e),
+                    "context": "opening socket",
+                }
+            ),
+            flush=True,
+        )
+        return
+
+    if args.socket:
+        infos = {"kind": "started", "addr": args.socket}
+    else:
+        host, port = server.server_address[:2]
+        infos = {
+            "kind": "started",
+            "addr": "{}:{}".format(host, port),
+            "host": host,
+            "port": port,
+        }
+    print(json.dumps(infos), flush=True)
+    # the plugin doesn't read anything else, don't block on a full pipe
+    sys.stdout = open(os.devnull, "w")
+    server.serve_forever()
+    server.done.wait(timeout=5)
+
+
+if __name__ == "__main__":
+    main()
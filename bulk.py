@@ -0,0 +1,344 @@
+""" Fixes many files (or views) at once.
+
+A Batch runs a function on every item on a bounded thread pool, with a bounded
+number of items in flight (so that walking a huge tree doesn't queue thousands
+of futures), reports its progress in the status bar, and can be cancelled.
+
+It drives the fix folder/project commands (fix_file) and save all (see
+JsonCommaSaveAllListener).
+"""
+
+import codecs
+import fnmatch
+import hashlib
+import itertools
+import os
+import threading
+import time
+import sublime
+from .server import server, notify, SETTINGS, MAX_CONCURRENT_FIXES
+from .stats import recorder
+
+SETTINGS_INCLUDE = "bulk_fix_include"
+SETTINGS_EXCLUDE = "bulk_fix_exclude"
+
+# the outcomes of fixing an item
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+# how often (in seconds) the progress is shown in the status bar
+PROGRESS_INTERVAL = 0.25
+
+# how long a batch waits for the server to start before fixing files anyway (in
+# which case small files are fixed in process)
+SERVER_START_TIMEOUT = 10
+
+# files are read (and written back) in chunks of this many bytes when they are
+# streamed to the server
+FILE_CHUNK_SIZE = 256 * 1024
+
+# the sha1 of the content of files we know are fixed, so that running the
+# same command twice doesn't send anything to the server
+known_fixed = set()
+
+# the batch currently running (one at a time), so that it can be cancelled
+current = None
+current_lock = threading.Lock()
+
+
+class Batch:
+    def __init__(self, label, *, workers=MAX_CONCURRENT_FIXES):
+        self.label = label
+        self.workers = workers
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+        self.total = 0
+        self.counts = dict.fromkeys((CHANGED, UNCHANGED, FAILED, SKIPPED), 0)
+        self.size = 0
+        self.started_at = None
+        self.duration = None
+        self._last_progress = 0
+
+    def start(self, items, work, *, on_done=None):
+        """ calls work(item) for every item from a background thread, work
+        should return (outcome, size). Returns right away """
+        items = list(items)
+        self.total = len(items)
+        self.started_at = time.monotonic()
+
+        def run():
+            try:
+                self.run(items, work)
+            finally:
+                self.duration = time.monotonic() - self.started_at
+                self.finished.set()
+                if on_done is not None:
+                    on_done(self)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def run(self, items, work):
+        import concurrent.futures
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = set()
+            for item in items:
+                if self.cancelled.is_set():
+                    break
+                if len(pending) >= 2 * self.workers:
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    self.collect(done)
+                pending.add(pool.submit(self.call, work, item))
+            self.collect(concurrent.futures.wait(pending)[0])
+
+    def call(self, work, item):
+        if self.cancelled.is_set():
+            return SKIPPED, 0
+        try:
+            return work(item)
+        except Exception as e:
+            print("JSONComma: failed to fix {}: {}".format(item, e))
+            return FAILED, 0
+
+    def collect(self, futures):
+        for future in futures:
+            outcome, size = future.result()
+            self.counts[outcome] += 1
+            self.size += size
+
+        if time.monotonic() - self._last_progress >= PROGRESS_INTERVAL:
+            self._last_progress = time.monotonic()
+            sublime.status_message(self.progress())
+
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    @property
+    def done(self):
+        return sum(self.counts.values())
+
+    def progress(self):
+        elapsed = (self.duration or time.monotonic() - self.started_at) or 1e-9
+        return "JSONComma: {} {}/{} ({} changed, {} failed, {:.1f} MB/s)".format(
+            self.label,
+            self.done,
+            self.total,
+            self.counts[CHANGED],
+            self.counts[FAILED],
+            self.size / elapsed / 1e6,
+        )
+
+
+def start(label, items, work):
+    """ starts a batch unless one is already running. Returns it, or None """
+    global current
+    with current_lock:
+        if current is not None and not current.finished.is_set():
+            notify("already {}, cancel it first", current.label)
+            return None
+        batch = current = Batch(label)
+
+    def on_done(batch):
+        notify(
+            "{} {} in {:.1f}s: {} changed, {} unchanged, {} failed",
+            "cancelled" if batch.cancelled.is_set() else "done",
+            batch.label,
+            batch.duration,
+            batch.counts[CHANGED],
+            batch.counts[UNCHANGED],
+            batch.counts[FAILED],
+        )
+
+    batch.start(items, work, on_done=on_done)
+    return batch
+
+
+def cancel():
+    with current_lock:
+        batch = current
+    if batch is None or batch.finished.is_set():
+        return False
+    batch.cancel()
+    return True
+
+
+def is_running():
+    with current_lock:
+        return current is not None and not current.finished.is_set()
+
+
+#
+# fixing files
+#
+
+
+def find_files(folders, include, exclude):
+    """ the files under folders matching one of the include globs and none of the
+    exclude ones. The globs are matched against the name and against the path
+    relative to the folder (directories matching exclude aren't walked) """
+
+    def matches(patterns, name, relative):
+        return any(
+            fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relative, pattern)
+            for pattern in patterns
+        )
+
+    for folder in folders:
+        for root, dirs, files in os.walk(folder):
+            relative_root = os.path.relpath(root, folder)
+            dirs[:] = [
+                name
+                for name in dirs
+                if not matches(
+                    exclude, name, os.path.normpath(os.path.join(relative_root, name))
+                )
+            ]
+            for name in files:
+                relative = os.path.normpath(os.path.join(relative_root, name))
+                if matches(include, name, relative) and not matches(
+                    exclude, name, relative
+                ):
+                    yield os.path.join(root, name)
+
+
+def fix_files(label, folders):
+    """ fixes the files under folders (see the bulk_fix_* settings) in the
+    background. Files open with unsaved changes are left alone """
+    settings = sublime.load_settings(SETTINGS)
+    include = settings.get(SETTINGS_INCLUDE) or ["*.json"]
+    exclude = settings.get(SETTINGS_EXCLUDE) or []
+    large_file_threshold = settings.get("large_file_threshold", 0)
+
+    unsaved = set(
+        view.file_name()
+        for window in sublime.windows()
+        for view in window.views()
+        if view.is_dirty() and view.file_name()
+    )
+
+    def work(path):
+        if path in unsaved:
+            return SKIPPED, 0
+        with recorder.timer("bulk.file"):
+            if 0 < large_file_threshold <= os.path.getsize(path):
+                return fix_large_file(path)
+            return fix_file(path)
+
+    def run():
+        wait_for_server()
+        with recorder.timer("bulk.walk"):
+            paths = list(find_files(folders, include, exclude))
+        if not paths:
+            notify("no files to fix (see the {} setting)", SETTINGS_INCLUDE)
+            return
+        start(label, paths, work)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def wait_for_server():
+    """ fixing without the server would work (for small files), but is a lot
+    slower. So, start it and give it a chance """
+    ready = threading.Event()
+    server.ensure_started(explicit=True)
+    server.when_ready(ready.set)
+    ready.wait(SERVER_START_TIMEOUT)
+
+
+def fix_file(path):
+    with open(path, "rb") as fp:
+        data = fp.read()
+
+    digest = hashlib.sha1(data).digest()
+    if digest in known_fixed:
+        return UNCHANGED, len(data)
+
+    # the byte order mark isn't JSON, it's put back when writing the file
+    bom = codecs.BOM_UTF8 if data.startswith(codecs.BOM_UTF8) else b""
+    original = data[len(bom) :].decode("utf-8")
+    fixed = server.fix(original)
+    if fixed is None:
+        return FAILED, len(data)
+    if fixed == original:
+        known_fixed.add(digest)
+        return UNCHANGED, len(data)
+
+    encoded = bom + fixed.encode("utf-8")
+    write_atomically(path, [encoded])
+    known_fixed.add(hashlib.sha1(encoded).digest())
+    return CHANGED, len(data)
+
+
+def fix_large_file(path):
+    """ like fix_file, but only a chunk of the file is in memory at a time """
+    # read_chunks is called again if the request is retried
+    original_digests = []
+    with open(path, "rb") as fp:
+        bom = fp.read(len(codecs.BOM_UTF8))
+    if bom != codecs.BOM_UTF8:
+        bom = b""
+
+    def read_chunks():
+        original_digest = hashlib.sha1(bom)
+        original_digests.append(original_digest)
+        # utf-8-sig leaves the byte order mark out, it isn't JSON
+        with open(path, encoding="utf-8-sig", newline="") as fp:
+            while True:
+                chunk = fp.read(FILE_CHUNK_SIZE)
+                if not chunk:
+                    return
+                original_digest.update(chunk.encode("utf-8"))
+                yield chunk
+
+    fixed_chunks = server.fix_chunks(read_chunks, os.path.getsize(path))
+    if fixed_chunks is None:
+        return FAILED, os.path.getsize(path)
+
+    encoded = itertools.chain(
+        [bom], (chunk.encode("utf-8") for chunk in fixed_chunks)
+    )
+    replaced, fixed_digest = write_atomically(
+        path, encoded, unless=lambda digest: digest == original_digests[-1].digest()
+    )
+    known_fixed.add(fixed_digest)
+    return CHANGED if replaced else UNCHANGED, os.path.getsize(path)
+
+
+def write_atomically(path, chunks, *, unless=None):
+    """ writes the chunks (bytes) to a temporary file next to path, and then
+    replaces path with it, so that nobody ever sees a half written file. If
+    unless(sha1 digest of the content) is True, path is left alone. Returns
+    (whether path was replaced, the digest) """
+    import shutil
+    import tempfile
+
+    digest = hashlib.sha1()
+    fd, temporary_path = tempfile.mkstemp(
+        prefix=".jsoncomma-", dir=os.path.dirname(path)
+    )
+    try:
+        with open(fd, "wb") as fp:
+            for chunk in chunks:
+                digest.update(chunk)
+                fp.write(chunk)
+
+        if unless is not None and unless(digest.digest()):
+            os.remove(temporary_path)
+            return False, digest.digest()
+
+        shutil.copymode(path, temporary_path)
+        os.replace(temporary_path, path)
+    except BaseException:
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass
+        raise
+    return True, digest.digest()
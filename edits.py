@@ -0,0 +1,131 @@
+""" Computes the minimal edits between some text and its fixed version.
+
+jsoncomma only ever inserts and removes commas and whitespace, so instead of
+replacing the whole region with the server's response (which allocates a second
+copy of the text, creates a huge undo entry, and makes sublime re-highlight
+everything) we only insert/erase the few characters that changed.
+"""
+
+# characters the server might insert or remove
+COMMA_OR_WHITESPACE = ", \t\r\n"
+
+
+def common_prefix_length(a, i, b, j):
+    """ returns the length of the common prefix of a[i:] and b[j:], comparing
+    (exponentially growing/shrinking) slices rather than one character at a time """
+    length = 0
+    step = 1024
+    while True:
+        chunk = a[i + length : i + length + step]
+        if chunk == b[j + length : j + length + step]:
+            if len(chunk) < step:
+                # we got to the end of both strings
+                return length + len(chunk)
+            length += step
+            step = min(step * 2, 1024 * 1024)
+        elif step == 1:
+            return length
+        else:
+            step //= 2
+
+
+def comma_edits(original, fixed, max_edits):
+    """ returns a list of (begin, end, text) replacements (offsets in original,
+    sorted) which turn original into fixed. Returns None if fixed doesn't only
+    differ from original by commas and whitespace, or if it would take more than
+    max_edits replacements (at that point, replacing everything is cheaper).
+    """
+    return iter_comma_edits([original], [fixed], max_edits)
+
+
+def iter_comma_edits(original_chunks, fixed_chunks, max_edits):
+    """ same as comma_edits, but original and fixed are iterables of chunks (of
+    any size, they don't need to line up). Only a chunk of each is kept in
+    memory at a time, on top of the edits themselves.
+    """
+    original = ChunkReader(original_chunks)
+    fixed = ChunkReader(fixed_chunks)
+    edits = []
+    while True:
+        prefix = common_prefix_length(
+            original.text, original.position, fixed.text, fixed.position
+        )
+        original.position += prefix
+        fixed.position += prefix
+
+        if not original.available():
+            original.fill()
+        if not fixed.available():
+            fixed.fill()
+
+        original_char = original.peek()
+        fixed_char = fixed.peek()
+        if original_char is None and fixed_char is None:
+            return edits
+
+        if original_char == fixed_char:
+            # a chunk ended in the middle of identical text
+            continue
+
+        # prefer treating differences as commas: that's what the server actually
+        # changes, whitespace differences come along with them
+        if fixed_char == ",":
+            insert = True
+        elif original_char == ",":
+            insert = False
+        elif original_char is not None and original_char in COMMA_OR_WHITESPACE:
+            insert = False
+        elif fixed_char is not None and fixed_char in COMMA_OR_WHITESPACE:
+            insert = True
+        else:
+            return None
+
+        i = original.offset + original.position
+        if edits and edits[-1][1] == i:
+            begin, end, text = edits.pop()
+        elif len(edits) == max_edits:
+            return None
+        else:
+            begin, end, text = i, i, ""
+
+        if insert:
+            text += fixed_char
+            fixed.position += 1
+        else:
+            end += 1
+            original.position += 1
+
+        edits.append((begin, end, text))
+
+
+class ChunkReader:
+
+    """ Reads text from an iterable of chunks, only keeping the current chunk
+    (and whatever wasn't read from the previous one) in memory """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self.text = ""
+        # the index of the next character to read in text
+        self.position = 0
+        # the offset of text[0] in the whole text
+        self.offset = 0
+
+    def available(self):
+        return len(self.text) - self.position
+
+    def fill(self):
+        """ appends the next (non empty) chunk. Returns False at the end """
+        for chunk in self._chunks:
+            if chunk:
+                self.offset += self.position
+                self.text = self.text[self.position :] + chunk
+                self.position = 0
+                return True
+        return False
+
+    def peek(self):
+        """ the next character, or None at the end """
+        if self.position < len(self.text):
+            return self.text[self.position]
+        return None
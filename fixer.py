@@ -0,0 +1,90 @@
+""" An in-process version of jsoncomma's fixer.
+
+Sending a tiny selection to the server over HTTP costs more than fixing it
+ourselves, and the server isn't always available (downloading, updating,
+crashed...). This reproduces jsoncomma's rules:
+
+- a comma is added right after a value followed by another value
+- a comma which isn't between two values is removed (trailing commas,
+  duplicate commas, commas right after an opening bracket)
+
+Comments (// and /* */) are skipped, just like whitespace. So is a byte order
+mark (U+FEFF), which isn't a value.
+
+bench/conformance.py checks it against outputs recorded from the binary.
+"""
+
+import re
+
+TOKENS = re.compile(
+    r"""
+    (?P<string>"(?:[^"\\]|\\.)*"?)
+    | (?P<comment>//[^\n]*|/\*[\s\S]*?(?:\*/|\Z))
+    | (?P<punctuation>[][{},:])
+    | (?P<literal>[^\s\ufeff\][{},:"/]+|/)
+    """,
+    re.VERBOSE,
+)
+
+# what kind of token came before the current one (ignoring comments)
+START = 0
+VALUE = 1  # a string, a literal, or a closing bracket
+OPENING = 2
+COMMA = 3
+COLON = 4
+
+
+def fix(text):
+    """ returns text with the commas fixed """
+    # (offset, text to insert) or (offset, None) to remove the comma at offset
+    edits = []
+    previous = START
+    previous_end = 0
+    pending_comma = None
+
+    for match in TOKENS.finditer(text):
+        kind = match.lastgroup
+        token = match.group()
+        if kind == "comment":
+            continue
+
+        if token == ",":
+            if pending_comma is not None or previous in (OPENING, COMMA, COLON):
+                edits.append((match.start(), None))
+            else:
+                pending_comma = match.start()
+            previous = COMMA
+        elif token == ":":
+            pending_comma = None
+            previous = COLON
+        elif token in "]}":
+            if pending_comma is not None:
+                edits.append((pending_comma, None))
+                pending_comma = None
+            previous = VALUE
+        else:
+            # the start of a value: a string, a literal, or an opening bracket
+            if pending_comma is not None:
+                pending_comma = None
+            elif previous == VALUE:
+                edits.append((previous_end, ","))
+            previous = OPENING if token in "[{" else VALUE
+
+        previous_end = match.end()
+
+    if not edits:
+        return text
+
+    edits.sort(key=lambda edit: edit[0])
+    parts = []
+    position = 0
+    for offset, insert in edits:
+        parts.append(text[position:offset])
+        if insert is None:
+            # skip the comma
+            position = offset + 1
+        else:
+            parts.append(insert)
+            position = offset
+    parts.append(text[position:])
+    return "".join(parts)
@@ -1,9 +1,78 @@
+import os
+import re
+import json
+import time
+import threading
 import sublime
 import sublime_plugin
-from functools import lru_cache
-from .server import server, notify
+from .server import server, notify, SETTINGS, CONNECTION_ERRORS, STOPPED, READY
+from .edits import comma_edits, iter_comma_edits
+from .stats import recorder
+from . import bulk
+from .tracing import tracer
 
 SETTING_VIEW_ENABLED = "jsoncomma_enabled"
+SETTINGS_PREFIX_DELAY = "prefix_delay_ms"
+SETTINGS_SAVE_DEADLINE = "save_deadline_ms"
+SETTINGS_LARGE_FILE_THRESHOLD = "large_file_threshold"
+SETTINGS_PREWARM_DELAY = "prewarm_delay_ms"
+SETTINGS_EMBEDDED = "fix_embedded_json"
+SETTINGS_EMBEDDED_SELECTORS = "embedded_json_selectors"
+SETTINGS_FIX_ON_PASTE = "fix_on_paste"
+
+# the commands after which we know exactly what was inserted (see pasted_regions)
+PASTE_COMMANDS = ("paste", "paste_and_indent")
+
+# the commands which only modify the lines under the cursors. When anything else
+# modifies the buffer (find and replace all, other plugins, ...), we don't know
+# which lines changed, so the whole buffer is fixed
+CURSOR_COMMANDS = frozenset(
+    (
+        "insert",
+        "insert_snippet",
+        "left_delete",
+        "right_delete",
+        "delete_word",
+        "cut",
+        "commit_completion",
+        "insert_best_completion",
+    )
+    + PASTE_COMMANDS
+)
+
+# the text modified since the last fix is stored with view.add_regions, that way
+# sublime keeps the offsets up to date as the user edits the text.
+DIRTY_REGIONS_KEY = "jsoncomma_dirty"
+
+# if the modifications are too scattered, it's cheaper to fix the whole buffer
+# than to look for the enclosing brackets of each and every one of them
+MAX_DIRTY_REGIONS = 32
+# if the regions we would send cover more than this fraction of the buffer, just
+# send the whole buffer
+MAX_DIRTY_FRACTION = 0.5
+
+# how many times fixing a file after it was saved is retried while the server is
+# up but failing (breaker open, timeouts...). The next save starts over
+MAX_SAVE_RETRIES = 3
+
+# how far (in characters) we are willing to look for the brackets enclosing a
+# dirty region, and how much text we read from the view at a time to do so
+MAX_ENCLOSING_SCAN = 1024 * 1024
+ENCLOSING_SCAN_CHUNK = 64 * 1024
+
+# past this many edits, we just replace the whole region (it's one API call
+# instead of thousands)
+MAX_EDITS = 1000
+
+# regions larger than large_file_threshold are streamed to the server in chunks
+# of this many characters (and diffed against the response chunk by chunk)
+LARGE_FILE_CHUNK_SIZE = 256 * 1024
+# when streaming, we only fall back to replacing the whole region when there are
+# really too many edits (we'd have to read the whole response from disk)
+MAX_STREAMED_EDITS = 10 * MAX_EDITS
+
+# strings and comments are matched so that the brackets they contain are skipped
+BRACKETS = re.compile(r'"(?:[^"\\\n]|\\.)*"?|//[^\n]*|/\*[\s\S]*?(?:\*/|\Z)|[][{}]')
 
 
 def should_be_enabled(*, filename, syntax, scope):
@@ -21,24 +90,60 @@ def should_be_enabled(*, filename, syntax, scope):
     # would it make sense to outsource this? No, because
     # this behavior is editor dependent.
     return (
-        "json" in syntax.lower()
-        or "json" in scope.lower()
+        "json" in scope.lower()
         or "json" in filename.split(".")[-1].lower()
-        # this is the most expensive check, hence it's used last
-        or "json" in get_syntax_name(syntax).lower()
+        or is_json_syntax(syntax)
+    )
+
+
+# syntax resource -> whether it's JSON-like. It's built in the background when the
+# plugin loads (see build_syntax_index), and completed lazily for the syntaxes
+# installed after that. It's bounded by the number of syntaxes.
+syntax_index = {}
+
+# the name of a .tmLanguage's scope (its "name" key isn't unique, every pattern
+# has one)
+TMLANGUAGE_SCOPE = re.compile(r"<key>\s*scopeName\s*</key>\s*<string>([^<]*)</string>")
+
+
+def is_json_syntax(syntax):
+    """ O(1) once the index is built """
+    json_like = syntax_index.get(syntax)
+    if json_like is None:
+        json_like = syntax_index[syntax] = classify_syntax(syntax)
+    return json_like
+
+
+def classify_syntax(syntax):
+    return "json" in syntax.lower() or "json" in get_syntax_name(syntax).lower()
+
+
+def build_syntax_index():
+    started_at = time.perf_counter()
+    resources = sublime.find_resources("*.sublime-syntax") + sublime.find_resources(
+        "*.tmLanguage"
     )
+    for resource in resources:
+        if resource not in syntax_index:
+            syntax_index[resource] = classify_syntax(resource)
+    recorder.record("startup.syntax_index", time.perf_counter() - started_at)
 
 
-# this is quite an expensive function, and it's
-# really cheap to cache (a pair of strings)
-@lru_cache()
 def get_syntax_name(syntax):
-    # FIXME: is there a cheap way to support .tmLanguage files?
-    # there is going to be fewer and fewer of them anyway...
-    if not syntax.endswith(".sublime-syntax"):
+    """ the name of a .sublime-syntax, or the scope of a .tmLanguage. This is
+    quite an expensive function (it loads the resource), hence the index """
+    if not syntax.endswith(".sublime-syntax") and not syntax.endswith(".tmLanguage"):
+        return ""
+
+    try:
+        content = sublime.load_resource(syntax)
+    except OSError:
         return ""
 
-    content = sublime.load_resource(syntax)
+    if syntax.endswith(".tmLanguage"):
+        match = TMLANGUAGE_SCOPE.search(content)
+        return match.group(1) if match else ""
+
     for i, line in enumerate(content.splitlines()):
         # assume it's somewhat decently formated. No people going `name  :`
         # for example
@@ -50,17 +155,283 @@ def get_syntax_name(syntax):
     return ""
 
 
+# view id -> should_be_enabled for that view. It's invalidated when the view's
+# syntax changes, and when it's saved (its file name might have changed)
+enabled_views = {}
+
+
+def is_enabled_view(view):
+    """ should_be_enabled for a view, cached """
+    view_id = view.id()
+    enabled = enabled_views.get(view_id)
+    if enabled is not None:
+        return enabled
+
+    enabled = enabled_views[view_id] = should_be_enabled(
+        filename=view.file_name() or "",
+        syntax=view.settings().get("syntax") or "",
+        scope=view.scope_name(view.size()),
+    )
+
+    settings = view.settings()
+    syntax = settings.get("syntax")
+
+    def on_change():
+        if settings.get("syntax") != syntax:
+            enabled_views.pop(view_id, None)
+            settings.clear_on_change("jsoncomma_enabled_view")
+
+    settings.add_on_change("jsoncomma_enabled_view", on_change)
+    return enabled
+
+
+def embedded_regions(view):
+    """ the JSON islands of a non JSON view (code blocks in markdown, etc), as
+    matched by the embedded_json_selectors setting """
+    selectors = sublime.load_settings(SETTINGS).get(SETTINGS_EMBEDDED_SELECTORS, [])
+    regions = []
+    for selector in selectors:
+        regions.extend(view.find_by_selector(selector))
+    return merge_regions(regions)
+
+
+def find_brackets(text):
+    """ yields (offset, bracket) for every bracket in text which isn't in a string
+    or a comment. text should start at the beginning of a line (JSON strings can't
+    span multiple lines, so that's a safe place to start tokenizing from) """
+    for match in BRACKETS.finditer(text):
+        if len(match.group()) == 1 and match.group() in "[]{}":
+            yield match.start(), match.group()
+
+
+def find_opening_bracket(view, point, count):
+    """ returns the offset of the count-th unmatched opening bracket before point
+    (which should be the beginning of a line), or None if there isn't one """
+    depth = count
+    end = point
+    while end > 0 and point - end < MAX_ENCLOSING_SCAN:
+        begin = view.line(max(0, end - ENCLOSING_SCAN_CHUNK)).begin()
+        brackets = list(find_brackets(view.substr(sublime.Region(begin, end))))
+        for offset, bracket in reversed(brackets):
+            if bracket in "]}":
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth == 0:
+                return begin + offset
+
+        end = begin
+    return None
+
+
+def find_closing_bracket(view, point, count):
+    """ returns the offset of the count-th unmatched closing bracket after point
+    (which should be the end of a line), or None if there isn't one """
+    depth = count
+    begin = point
+    size = view.size()
+    while begin < size and begin - point < MAX_ENCLOSING_SCAN:
+        end = view.line(min(size, begin + ENCLOSING_SCAN_CHUNK)).end()
+        for offset, bracket in find_brackets(view.substr(sublime.Region(begin, end))):
+            if bracket in "[{":
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth == 0:
+                return begin + offset
+
+        # end is the end of a line, so we step over the new line character
+        begin = end + 1
+    return None
+
+
+def enclosing_region(view, region):
+    """ expands region (made of whole lines) to the nearest object or array that
+    encloses it entirely. Returns None if there is no such object/array """
+
+    # the brackets in region which are matched outside of it
+    unmatched_closing = 0
+    unmatched_opening = 0
+    for _, bracket in find_brackets(view.substr(region)):
+        if bracket in "[{":
+            unmatched_opening += 1
+        elif unmatched_opening > 0:
+            unmatched_opening -= 1
+        else:
+            unmatched_closing += 1
+
+    begin = find_opening_bracket(view, region.begin(), unmatched_closing + 1)
+    if begin is None:
+        return None
+
+    end = find_closing_bracket(view, region.end(), unmatched_opening + 1)
+    if end is None:
+        return None
+
+    return sublime.Region(begin, end + 1)
+
+
+def merge_regions(regions):
+    """ merges overlapping and touching regions. Returns a sorted list """
+    merged = []
+    for region in sorted(regions, key=lambda region: region.begin()):
+        if merged and region.begin() <= merged[-1].end():
+            merged[-1] = merged[-1].cover(region)
+        else:
+            merged.append(region)
+    return merged
+
+
+def pasted_regions(before, after):
+    """ the regions a paste inserted, given the selection right before it (as
+    (begin, end) tuples) and right after it (a cursor at the end of each pasted
+    text). Returns None if they don't match up """
+    if len(before) != len(after) or any(not cursor.empty() for cursor in after):
+        return None
+
+    regions = []
+    # how much the previous pastes moved the text
+    shift = 0
+    for (begin, end), cursor in zip(before, after):
+        begin += shift
+        if cursor.end() < begin:
+            return None
+        if cursor.end() > begin:
+            regions.append(sublime.Region(begin, cursor.end()))
+        shift = cursor.end() - end
+    return regions
+
+
+def compute_fixes(view, regions, *, partial=False):
+    """ sends the regions to the server (concurrently), and returns a sorted list
+    of (region, edits), where edits are (begin, end, text) replacements relative
+    to the region. If one of the regions can't be fixed, it returns None, unless
+    partial is True (in which case that region is left out).
+
+    Regions larger than the large_file_threshold setting are streamed (see
+    compute_large_fix) instead of being read whole.
+    """
+    threshold = sublime.load_settings(SETTINGS).get(SETTINGS_LARGE_FILE_THRESHOLD, 0)
+    regions = sorted(regions, key=lambda region: region.begin())
+    large = [0 < threshold <= region.size() for region in regions]
+    small_regions = [region for region, is_large in zip(regions, large) if not is_large]
+
+    size = sum(region.size() for region in small_regions)
+    with recorder.timer("view.substr", size):
+        originals = [view.substr(region) for region in small_regions]
+    with recorder.timer("fix", size):
+        fixed_texts = iter(server.fix_many(originals))
+    originals = iter(originals)
+
+    fixes = []
+    for region, is_large in zip(regions, large):
+        if is_large:
+            with recorder.timer("fix.large", region.size()):
+                edits = compute_large_fix(view, region)
+        else:
+            original, fixed = next(originals), next(fixed_texts)
+            edits = None if fixed is None else minimal_edits(region, original, fixed)
+
+        if edits is None:
+            if not partial:
+                return None
+            continue
+        fixes.append((region, edits))
+    return fixes
+
+
+def minimal_edits(region, original, fixed):
+    """ the edits to apply to region to turn original into fixed. Only the
+    characters that changed are inserted/erased, so that we don't rewrite (and
+    re-highlight) the whole region, and keep the selections and folds where they
+    were """
+    if original == fixed:
+        return []
+
+    edits = comma_edits(original, fixed, MAX_EDITS)
+    if edits is None:
+        return [(0, region.size(), fixed)]
+    return edits
+
+
+def compute_large_fix(view, region):
+    """ streams region to the server (reading it from the view chunk by chunk)
+    and diffs the response against the view as it comes in, so that the extra
+    memory we use is proportional to the chunk size (and the number of edits),
+    not to the size of the region. The response is spooled to disk in case we
+    need it whole (ie. the server changed more than commas and whitespace).
+    Returns the edits, or None if it failed """
+
+    def read_chunks():
+        for begin in range(region.begin(), region.end(), LARGE_FILE_CHUNK_SIZE):
+            end = min(begin + LARGE_FILE_CHUNK_SIZE, region.end())
+            yield view.substr(sublime.Region(begin, end))
+
+    fixed_chunks = server.fix_chunks(read_chunks, region.size())
+    if fixed_chunks is None:
+        return None
+
+    import tempfile
+
+    with tempfile.TemporaryFile("w+", encoding="utf-8") as spool:
+
+        def spooled(chunks):
+            for chunk in chunks:
+                spool.write(chunk)
+                yield chunk
+
+        try:
+            edits = iter_comma_edits(
+                read_chunks(), spooled(fixed_chunks), MAX_STREAMED_EDITS
+            )
+            if edits is not None:
+                return edits
+
+            # consume whatever is left of the response
+            for _ in spooled(fixed_chunks):
+                pass
+        except CONNECTION_ERRORS as e:
+            notify("connection error while streaming to the server ({})", e)
+            return None
+
+        spool.seek(0)
+        return [(0, region.size(), spool.read())]
+
+
+class FixJob:
+
+    """ Fixes computed in the background for a specific version (change count)
+    of a view """
+
+    def __init__(self, change_count):
+        self.change_count = change_count
+        # None if the fixes couldn't be computed (or are outdated)
+        self.fixes = None
+        self.done = threading.Event()
+
+
 def plugin_loaded():
-    # start async because server.start might download jsoncomma synchronously
-    # (ie. it would block the editor)
-    sublime.set_timeout_async(server.start, 0)
+    # the server isn't started here: it's started when a JSON-like view is
+    # activated (see JsonCommaListener.on_activated_async), or on the first fix.
+    # That way, it doesn't run at all if no JSON is ever opened.
+    # The syntax index is built in the background (and timed as
+    # startup.syntax_index), this only queues it.
+    sublime.set_timeout_async(build_syntax_index, 0)
 
 
 def plugin_unloaded():
-    server.stop()
+    if server.state != STOPPED:
+        server.release()
+    tracer.close()
 
 
 class JsonCommaListener(sublime_plugin.ViewEventListener):
+
+    # view id -> listener, so that save all can prefix every view at once
+    instances = {}
+
     @classmethod
     def is_applicable(cls, settings):
         explicit = settings.get(SETTING_VIEW_ENABLED)
@@ -69,36 +440,401 @@ class JsonCommaListener(sublime_plugin.ViewEventListener):
         elif explicit is True:
             return True
 
-        return should_be_enabled(
-            filename="", syntax=settings.get("syntax") or "", scope=""
+        syntax = settings.get("syntax") or ""
+        if should_be_enabled(filename="", syntax=syntax, scope=""):
+            return True
+
+        # in other views, we only fix the JSON islands (see embedded_regions)
+        return bool(
+            sublime.load_settings(SETTINGS).get(SETTINGS_EMBEDDED)
+            and not settings.get("is_widget")
         )
 
     @classmethod
     def applies_to_primary_view_only(cls):
         return False
 
+    def __init__(self, view):
+        super().__init__(view)
+        # we don't know which parts of a buffer we haven't fixed yet are valid
+        self.needs_full_fix = True
+        # the change count right after our last fix, so that we don't mark our own
+        # modifications as dirty
+        self.fixed_change_count = None
+        self.fixing = False
+        # the last background fix we started
+        self.job = None
+        self.fix_after_save = False
+        self.waiting_for_server = False
+        # how many times fix_and_save failed since the last save
+        self.save_retries = 0
+        # the selection right before a paste, as (begin, end) tuples
+        self.before_paste = None
+        # the change count the last time on_modified was called
+        self.seen_change_count = view.change_count()
+        # the text command being run (between on_text_command and
+        # on_post_text_command)
+        self.command_name = None
+        self.instances[view.id()] = self
+
+    def is_embedded(self):
+        """ whether we only fix the JSON islands of this view (rather than the
+        whole view) """
+        if self.view.settings().get(SETTING_VIEW_ENABLED) is True:
+            return False
+        return not is_enabled_view(self.view)
+
+    def on_modified(self):
+        change_count = self.view.change_count()
+        modifications = change_count - self.seen_change_count
+        self.seen_change_count = change_count
+
+        if self.fixing or change_count == self.fixed_change_count:
+            return
+
+        if self.is_embedded():
+            # the islands are found again on every fix, they are cheap to find
+            return
+
+        # on_modified only tells us that something changed, not where. We assume
+        # it's under the cursors only when the command that did it works that way
+        # (at most one modification per cursor). Undo, redo, macros, ... don't
+        command_name = self.command_name or self.view.command_history(0, True)[0]
+        if (
+            command_name not in CURSOR_COMMANDS
+            or modifications > max(1, len(self.view.sel()))
+        ):
+            self.mark_all_dirty()
+            return
+
+        self.mark_dirty([self.view.full_line(region) for region in self.view.sel()])
+
+    def mark_dirty(self, regions):
+        """ adds regions to the ones we need to fix """
+        if self.needs_full_fix:
+            return
+
+        regions = merge_regions(self.view.get_regions(DIRTY_REGIONS_KEY) + regions)
+
+        if len(regions) > MAX_DIRTY_REGIONS:
+            self.mark_all_dirty()
+            return
+
+        self.view.add_regions(DIRTY_REGIONS_KEY, regions, "", "", sublime.HIDDEN)
+
+    def mark_all_dirty(self):
+        """ the next fix will fix the whole buffer """
+        self.needs_full_fix = True
+        self.view.erase_regions(DIRTY_REGIONS_KEY)
+
+    def on_text_command(self, command_name, args):
+        self.command_name = command_name
+        if command_name in PASTE_COMMANDS:
+            self.before_paste = [
+                (region.begin(), region.end()) for region in self.view.sel()
+            ]
+
+    def on_post_text_command(self, command_name, args):
+        self.command_name = None
+        before_paste, self.before_paste = self.before_paste, None
+        if command_name not in PASTE_COMMANDS or before_paste is None:
+            return
+        if self.is_embedded():
+            return
+
+        pasted = pasted_regions(before_paste, list(self.view.sel()))
+        if not pasted:
+            return
+
+        # on_modified only saw where the cursors ended up
+        lines = [self.view.full_line(region) for region in pasted]
+        self.mark_dirty(lines)
+
+        if sublime.load_settings(SETTINGS).get(SETTINGS_FIX_ON_PASTE, False):
+            self.fix_pasted(pasted)
+
+    def fix_pasted(self, pasted):
+        """ fixes the pasted text in the background, and applies the fixes (as
+        their own undo step) unless the view changed in the meantime. Only the
+        pasted text is sent, however large the document: the lines around it
+        stay dirty, and are fixed on save """
+        job = FixJob(self.view.change_count())
+
+        def run():
+            if self.view.change_count() == job.change_count:
+                with recorder.timer("paste", sum(region.size() for region in pasted)):
+                    fixes = compute_fixes(self.view, pasted)
+                if self.view.change_count() == job.change_count:
+                    job.fixes = fixes
+            job.done.set()
+            if job.fixes is not None:
+                sublime.set_timeout(apply, 0)
+
+        def apply():
+            if self.view.is_valid():
+                self.apply(job, whole_buffer=False)
+
+        sublime.set_timeout_async(run, 0)
+
+    def on_activated_async(self):
+        # start the server now, so that the first save doesn't have to wait for it.
+        # The delay is so that we don't start it when the user is just going
+        # through their tabs.
+        delay = sublime.load_settings(SETTINGS).get(SETTINGS_PREWARM_DELAY, 500)
+        if delay < 0 or server.state != STOPPED or self.is_embedded():
+            # islands are usually small enough to be fixed in process
+            return
+
+        def prewarm():
+            window = self.view.window()
+            if window is not None and window.active_view() == self.view:
+                # the server is started by a background thread because server.start
+                # might download jsoncomma synchronously (ie. it would block the
+                # editor)
+                server.ensure_started()
+
+        sublime.set_timeout_async(prewarm, delay)
+
+    def on_revert(self):
+        self.mark_all_dirty()
+
+    def on_modified_async(self):
+        # wait for the edits to settle before fixing things in the background
+        change_count = self.view.change_count()
+        if change_count == self.fixed_change_count:
+            # that's our own fix
+            return
+
+        delay = sublime.load_settings(SETTINGS).get(SETTINGS_PREFIX_DELAY, 500)
+        if delay < 0:
+            return
+
+        def on_idle():
+            if self.view.change_count() == change_count:
+                self.prefix()
+
+        sublime.set_timeout_async(on_idle, delay)
+
     def on_pre_save(self):
-        self.view.run_command("jsoncomma_fix", {"ranges": [(0, self.view.size())]})
+        if JsoncommaFixCommand.is_fixed(self.view):
+            # another view on the same buffer already fixed it
+            self.mark_fixed()
+            return
+
+        job = self.prefix()
+        deadline = sublime.load_settings(SETTINGS).get(SETTINGS_SAVE_DEADLINE, 100)
+        if not job.done.wait(deadline / 1000) or job.fixes is None:
+            # don't block the editor, save as is and fix right after
+            self.fix_after_save = True
+            return
+
+        self.apply(job)
+
+    def on_post_save_async(self):
+        if not self.fix_after_save:
+            return
+        self.fix_after_save = False
+        self.save_retries = 0
+        self.fix_and_save()
+
+    def fix_and_save(self):
+        """ fixes the view (from the async thread) and saves it again. If the
+        server isn't available, it tries again once it is """
+        # computed right here: a job queued with set_timeout_async would wait
+        # for this very thread
+        job = self.prefix(now=True)
+        if job.fixes is None:
+            # keep the dirty regions around. The text the user saved isn't lost,
+            # we'll fix it as soon as the server is back
+            self.retry_fix_and_save()
+            return
+
+        def apply_and_save():
+            if self.apply(job) and self.view.is_dirty():
+                self.view.run_command("save")
+
+        sublime.set_timeout(apply_and_save, 0)
+
+    def retry_fix_and_save(self):
+        if self.waiting_for_server:
+            return
+        if server.state != READY:
+            self.waiting_for_server = True
+            server.when_ready(self.on_server_ready)
+            return
+
+        # the server is there, but failed to fix it. Trying again right away
+        # would most likely fail the same way
+        self.save_retries += 1
+        if self.save_retries > MAX_SAVE_RETRIES:
+            notify(
+                "couldn't fix {} after saving it, will try again on the next save",
+                self.view.file_name() or "the view",
+            )
+            return
+        self.waiting_for_server = True
+        sublime.set_timeout_async(self.on_server_ready, server.breaker.cooldown * 1000)
+
+    def on_server_ready(self):
+        self.waiting_for_server = False
+        if self.view.is_valid():
+            sublime.set_timeout_async(self.fix_and_save, 0)
+
+    def prefix(self, *, now=False):
+        """ starts fixing the current content of the view in the background
+        (unless it's already being done), and returns the job. If now is True,
+        the fixes are computed right away, in the calling thread (the job is
+        done when it returns) """
+        change_count = self.view.change_count()
+        job = self.job
+        if job is not None and job.change_count == change_count:
+            failed = job.done.is_set() and job.fixes is None
+            # a job that hasn't run yet might be queued on the calling thread
+            pending = now and not job.done.is_set()
+            if not failed and not pending:
+                return job
+
+        job = self.job = FixJob(change_count)
+
+        def run():
+            if self.view.change_count() == job.change_count:
+                fixes = compute_fixes(self.view, self.regions_to_fix())
+                # the fixes are only valid for the text we read
+                if self.view.change_count() == job.change_count:
+                    job.fixes = fixes
+            job.done.set()
+
+        if now:
+            run()
+        else:
+            sublime.set_timeout_async(run, 0)
+        return job
+
+    def apply(self, job, *, whole_buffer=True):
+        """ applies the job's fixes if they are still up to date. Returns True
+        if it did. If whole_buffer is True, the buffer is then marked as fixed """
+        JsoncommaFixCommand.precomputed[self.view.id()] = job
+        self.fixing = True
+        try:
+            self.view.run_command("jsoncomma_fix", {"precomputed": True})
+        finally:
+            self.fixing = False
+
+        if not JsoncommaFixCommand.succeeded.get(self.view.id(), False):
+            return False
+
+        if whole_buffer:
+            self.mark_fixed()
+        return True
+
+    def mark_fixed(self):
+        """ marks the whole buffer as fixed as of now """
+        self.needs_full_fix = False
+        self.fixed_change_count = self.view.change_count()
+        self.view.erase_regions(DIRTY_REGIONS_KEY)
+        buffer_id = self.view.buffer_id()
+        JsoncommaFixCommand.fixed_buffers[buffer_id] = self.fixed_change_count
+
+    def on_close(self):
+        self.instances.pop(self.view.id(), None)
+        JsoncommaFixCommand.succeeded.pop(self.view.id(), None)
+        JsoncommaFixCommand.precomputed.pop(self.view.id(), None)
+        JsoncommaFixCommand.fixed_buffers.pop(self.view.buffer_id(), None)
+
+    def regions_to_fix(self):
+        """ the smallest set of objects/arrays that include every modification
+        since the last fix. It falls back to the whole buffer when that isn't
+        worth it (or possible) """
+        if self.is_embedded():
+            return embedded_regions(self.view)
+
+        everything = [sublime.Region(0, self.view.size())]
+        if self.needs_full_fix:
+            return everything
+
+        regions = []
+        for dirty in self.view.get_regions(DIRTY_REGIONS_KEY):
+            region = enclosing_region(self.view, self.view.full_line(dirty))
+            if region is None:
+                # modified at the top level
+                return everything
+            regions.append(region)
+
+        # the enclosing regions are either nested or disjoint
+        regions = merge_regions(regions)
+        dirty_size = sum(region.size() for region in regions)
+        if dirty_size > MAX_DIRTY_FRACTION * self.view.size():
+            return everything
+
+        return regions
 
 
 class JsoncommaFixCommand(sublime_plugin.TextCommand):
-    def run(self, edit, ranges=None):
+
+    # view id -> whether every region was fixed on the last run. Commands can't
+    # return anything, this is how the listener knows whether the fix went through
+    succeeded = {}
+
+    # buffer id -> change count right after the whole buffer was last fixed.
+    # That's how we know there is nothing to do (save all, cloned views, etc)
+    fixed_buffers = {}
+
+    @classmethod
+    def is_fixed(cls, view):
+        return cls.fixed_buffers.get(view.buffer_id()) == view.change_count()
+
+    # view id -> FixJob computed in the background, applied with precomputed=True
+    precomputed = {}
+
+    def run(self, edit, ranges=None, precomputed=False):
+        if precomputed:
+            job = self.precomputed.pop(self.view.id(), None)
+            if job is None or job.change_count != self.view.change_count():
+                # the text changed since the fixes were computed
+                self.succeeded[self.view.id()] = False
+                return
+            self.apply_fixes(edit, job.fixes)
+            self.succeeded[self.view.id()] = True
+            return
+
+        # the user asked for it (see server.block_start)
+        server.ensure_started(explicit=True)
+
         if ranges is not None:
-            regions = (sublime.Region(*range) for range in ranges)
+            regions = [sublime.Region(*range) for range in ranges]
         else:
-            regions = self.view.sel()
+            regions = list(self.view.sel())
+
+        whole_buffer = len(regions) == 1 and regions[0].size() == self.view.size()
+        if whole_buffer and self.is_fixed(self.view):
+            self.succeeded[self.view.id()] = True
+            return
+
+        with recorder.timer("command", sum(region.size() for region in regions)):
+            fixes = compute_fixes(self.view, regions, partial=True)
+            self.apply_fixes(edit, fixes)
 
-        for region in regions:
-            self.view.replace(edit, region, server.fix(self.view.substr(region)))
+        succeeded = len(fixes) == len(regions)
+        self.succeeded[self.view.id()] = succeeded
+        if whole_buffer and succeeded:
+            self.fixed_buffers[self.view.buffer_id()] = self.view.change_count()
+
+    def apply_fixes(self, edit, fixes):
+        size = sum(region.size() for region, _ in fixes)
+        with recorder.timer("view.replace", size):
+            # go from the end to the beginning so that replacing something doesn't
+            # move what we haven't fixed yet
+            for region, edits in reversed(fixes):
+                offset = region.begin()
+                for begin, end, text in reversed(edits):
+                    self.view.replace(
+                        edit, sublime.Region(offset + begin, offset + end), text
+                    )
 
     def is_visible(self):
 
         # don't show this command if we are already going to run on save
-        if should_be_enabled(
-            filename=self.view.file_name() or "",
-            syntax=self.view.settings().get("syntax") or "",
-            scope=self.view.scope_name(self.view.size()),
-        ):
+        if is_enabled_view(self.view):
             return False
 
         # return True if the user has selected some text
@@ -106,3 +842,135 @@ class JsoncommaFixCommand(sublime_plugin.TextCommand):
             if not region.empty():
                 return True
         return False
+
+
+class JsonCommaEnabledViewsListener(sublime_plugin.EventListener):
+
+    """ keeps the enabled_views cache up to date """
+
+    def on_post_save(self, view):
+        enabled_views.pop(view.id(), None)
+        view.settings().clear_on_change("jsoncomma_enabled_view")
+
+    def on_close(self, view):
+        enabled_views.pop(view.id(), None)
+
+
+class JsonCommaSaveAllListener(sublime_plugin.EventListener):
+
+    """ save all would fix the views one at a time (in on_pre_save). Instead,
+    fix all of them concurrently first, on_pre_save then finds its fixes ready """
+
+    def on_window_command(self, window, command_name, args):
+        if command_name != "save_all":
+            return None
+
+        listeners = []
+        for view in window.views():
+            listener = JsonCommaListener.instances.get(view.id())
+            if listener is not None and view.is_dirty():
+                if not JsoncommaFixCommand.is_fixed(view):
+                    listeners.append(listener)
+        if len(listeners) < 2:
+            return None
+
+        def work(listener):
+            job = listener.prefix(now=True)
+            outcome = bulk.FAILED if job.fixes is None else bulk.CHANGED
+            return outcome, listener.view.size()
+
+        batch = bulk.Batch("fixing before saving")
+        batch.start(listeners, work)
+        deadline = sublime.load_settings(SETTINGS).get(SETTINGS_SAVE_DEADLINE, 100)
+        batch.wait(deadline / 1000)
+        return None
+
+
+class JsoncommaFixFolderCommand(sublime_plugin.WindowCommand):
+
+    """ fixes the JSON files in a folder (see the bulk_fix_* settings). From the
+    side bar, dirs are the selected folders """
+
+    def run(self, dirs=None):
+        if dirs:
+            bulk.fix_files("fixing {}".format(", ".join(dirs)), dirs)
+            return
+
+        def on_done(path):
+            path = os.path.expanduser(path)
+            if not os.path.isdir(path):
+                notify("{} isn't a folder", path)
+                return
+            self.run(dirs=[path])
+
+        folders = self.window.folders()
+        self.window.show_input_panel(
+            "Fix JSON files in:", folders[0] if folders else "", on_done, None, None
+        )
+
+    def is_enabled(self, dirs=None):
+        return not bulk.is_running()
+
+
+class JsoncommaFixProjectCommand(sublime_plugin.WindowCommand):
+
+    """ fixes the JSON files in every folder of the window """
+
+    def run(self):
+        bulk.fix_files("fixing the project", self.window.folders())
+
+    def is_enabled(self):
+        return bool(self.window.folders()) and not bulk.is_running()
+
+
+class JsoncommaCancelBulkFixCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        bulk.cancel()
+
+    def is_enabled(self):
+        return bulk.is_running()
+
+
+class JsoncommaShowStatsCommand(sublime_plugin.WindowCommand):
+    def run(self, export=False):
+        if export:
+            path = os.path.join(
+                sublime.cache_path(),
+                "JSONComma",
+                "stats-{}.json".format(time.strftime("%Y%m%d-%H%M%S")),
+            )
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as fp:
+                json.dump(
+                    {
+                        "phases": recorder.summary(),
+                        "server": server.state,
+                        "breaker": {
+                            "state": server.breaker.state,
+                            "failures": server.breaker.failures,
+                            "opened": server.breaker.opened,
+                        },
+                        "cache": {
+                            "hits": server.cache.hits,
+                            "misses": server.cache.misses,
+                            "size": server.cache.size,
+                        },
+                    },
+                    fp,
+                    indent=4,
+                )
+            notify("performance stats exported to {}", path)
+            return
+
+        view = self.window.new_file()
+        view.set_name("JSONComma: Performance Stats")
+        view.set_scratch(True)
+        view.run_command(
+            "append",
+            {
+                "characters": "server: {}\nbreaker: {}\ncache: {}\n\n{}\n".format(
+                    server.state, server.breaker, server.cache, recorder.report()
+                )
+            },
+        )
+        view.set_read_only(True)
@@ -0,0 +1,6 @@
+""" Modules which are only imported when they are needed.
+
+Sublime Text imports every .py file at the root of the package when it starts
+(or reloads the plugin), these aren't. Keep anything slow to import (requests,
+tarfile, http.client...) in here, behind an import in the function using it.
+"""
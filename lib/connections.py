@@ -0,0 +1,34 @@
+""" The HTTP connections of the tcp and unix transports.
+
+http.client (and the email package it parses headers with) is slow to import,
+transport.py only imports this once it actually talks to the server.
+"""
+
+import http.client
+import socket
+
+from ..transport import CONNECT_TIMEOUT
+
+HTTPException = http.client.HTTPException
+
+
+class HTTPConnection(http.client.HTTPConnection):
+    def __init__(self, host, port):
+        super().__init__(host, port, timeout=CONNECT_TIMEOUT)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path):
+        # the host is only used for the Host header
+        super().__init__("localhost", timeout=CONNECT_TIMEOUT)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
@@ -0,0 +1,376 @@
+""" Downloading and updating the jsoncomma binary.
+
+Only imported when server.auto_update_executable runs: requests (and urllib3,
+certifi, chardet...), tarfile and shutil take longer to import than the rest
+of the plugin put together, and most editor starts never update anything.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+
+import requests
+import sublime
+
+from ..server import (
+    server,
+    notify,
+    file_signature,
+    start_process,
+    kill_nicely,
+    SETTINGS,
+    SETTINGS_RELEASE_API_URL,
+    SETTINGS_RELEASE_DOWNLOAD_URL,
+    SETTINGS_UPDATE_CHECK_INTERVAL,
+    UPDATING,
+)
+
+# the errors auto updating raises when GitHub can't be reached (or is too slow)
+NETWORK_ERRORS = (requests.ConnectionError, requests.Timeout)
+
+# (connect, read) timeouts for the requests to GitHub, in seconds. The read one
+# is how long we wait for the next bytes, not for the whole download. Updates
+# run while holding server.lifecycle_lock, a stalled connection mustn't hold it
+# (and every editor instance waiting for it) forever
+HTTP_TIMEOUT = (10, 30)
+
+# the size of the chunks we download the binary's archive in
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class DiskCache:
+
+    """ A small JSON file in sublime's cache directory, to remember things across
+    restarts (the latest release, the version of the binary, etc) """
+
+    def __init__(self, name):
+        self.name = name
+        self._data = None
+        self._lock = threading.Lock()
+
+    def path(self):
+        return os.path.join(sublime.cache_path(), "JSONComma", self.name)
+
+    def get(self, key):
+        with self._lock:
+            return self._load().get(key)
+
+    def set(self, key, value):
+        with self._lock:
+            self._load()[key] = value
+            path = self.path()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "w") as fp:
+                json.dump(self._data, fp)
+            os.replace(path + ".tmp", path)
+
+    def _load(self):
+        if self._data is None:
+            try:
+                with open(self.path()) as fp:
+                    self._data = json.load(fp)
+            except (OSError, ValueError):
+                # missing or corrupted, it's just a cache
+                self._data = {}
+        return self._data
+
+
+disk_cache = DiskCache("cache.json")
+
+
+def update_executable(executable_path):
+    """ downloads the latest release to executable_path, unless it's already
+    up to date. Returns executable_path """
+
+    settings = sublime.load_settings(SETTINGS)
+    release = get_latest_release()
+    latest_version = release["tag_name"][1:]
+
+    try:
+        current_version = get_current_executable_version(executable_path)
+    except FileNotFoundError as e:
+        # we are going to download it
+        notify(
+            "current version: non existent ({!r}), latest version: {}",
+            e,
+            latest_version,
+        )
+    else:
+        if current_version == latest_version:
+            # don't need to update
+            return executable_path
+
+        notify(
+            "current version: {}, latest version: {}".format(
+                current_version, latest_version
+            )
+        )
+
+    platforms = {
+        # sublime.plaform() -> goreleaser's platform names
+        "windows": "Windows",
+        "osx": "Darwin",
+        "linux": "Linux",
+    }
+
+    archs = {
+        # sublime.arch() -> goreleaser's arch names
+        "x32": "i386",
+        "x64": "x86_64",
+    }
+
+    archive_name = "jsoncomma_v{version}_{platform}_{arch}.tar.gz".format(
+        version=latest_version,
+        platform=platforms[sublime.platform()],
+        arch=archs[sublime.arch()],
+    )
+    download_url = "{base}/v{version}/{name}".format(
+        base=settings.get(SETTINGS_RELEASE_DOWNLOAD_URL).rstrip("/"),
+        version=latest_version,
+        name=archive_name,
+    )
+
+    os.makedirs(os.path.dirname(executable_path), exist_ok=True)
+
+    # we never write to executable_path directly: everything goes to temporary
+    # files next to it, and the new binary is renamed over the old one once
+    # it's complete. An interrupted update never leaves a truncated binary.
+    archive_path = None
+    new_executable_path = None
+    try:
+        notify("downloading binary from {}", download_url)
+        archive_path, size, sha256 = download(download_url, executable_path)
+
+        assets = {asset["name"]: asset for asset in release.get("assets", [])}
+        if archive_name in assets:
+            assert (
+                size == assets[archive_name]["size"]
+            ), "[downloading] expected {} bytes, got {}".format(
+                assets[archive_name]["size"], size
+            )
+
+        expected_sha256 = get_checksum(assets, archive_name)
+        if expected_sha256 is None:
+            print("JSONComma: no checksum found for {}".format(archive_name))
+        else:
+            assert (
+                sha256 == expected_sha256
+            ), "[downloading] checksum mismatch for {} (expected {}, got {})".format(
+                archive_name, expected_sha256, sha256
+            )
+
+        notify("extracting tar...")
+        new_executable_path = extract_executable(archive_path, executable_path)
+        os.chmod(
+            new_executable_path,
+            os.stat(new_executable_path).st_mode | stat.S_IEXEC,
+        )
+
+        # make sure the server is stopped before we update the binary
+        server.stop()
+        server.set_state(UPDATING)
+        os.replace(new_executable_path, executable_path)
+        new_executable_path = None
+    finally:
+        for path in (archive_path, new_executable_path):
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+    # the new version might not fix things the same way
+    server.cache.clear()
+
+    # FIXME: maybe we should have a platform dependent settings file...
+
+    return executable_path
+
+
+def get_latest_release():
+    """ Gets the latest release (as returned by GitHub's API). The result is
+    cached on disk, and only revalidated (with the ETag GitHub gave us) every
+    update_check_interval_hours
+    """
+    settings = sublime.load_settings(SETTINGS)
+    url = settings.get(SETTINGS_RELEASE_API_URL)
+    ttl = settings.get(SETTINGS_UPDATE_CHECK_INTERVAL, 6) * 60 * 60
+
+    cached = disk_cache.get("latest_release")
+    if cached is not None and cached["url"] != url:
+        cached = None
+
+    if cached is not None and time.time() - cached["checked_at"] < ttl:
+        return cached["release"]
+
+    notify("checking last release...")
+    headers = {}
+    if cached is not None and cached["etag"]:
+        headers["If-None-Match"] = cached["etag"]
+    resp = requests.get(url, headers=headers, timeout=HTTP_TIMEOUT)
+
+    if resp.status_code == 304:
+        cached["checked_at"] = time.time()
+        disk_cache.set("latest_release", cached)
+        return cached["release"]
+
+    assert (
+        resp.status_code == 200
+    ), "[getting last release] expected 200 status code, got {}".format(
+        resp.status_code
+    )
+
+    releases = resp.json()
+    for release in releases:
+        # ignore prereleases and drafts
+        if release["draft"] or release["prerelease"]:
+            continue
+
+        assert release["tag_name"].startswith(
+            "v"
+        ), "expected tag name to start with 'v' in {!r}".format(release["tag_name"])
+
+        # only keep what we use, the full release is quite big
+        release = {
+            "tag_name": release["tag_name"],
+            "assets": [
+                {
+                    "name": asset["name"],
+                    "size": asset["size"],
+                    "browser_download_url": asset["browser_download_url"],
+                }
+                for asset in release.get("assets", [])
+            ],
+        }
+        disk_cache.set(
+            "latest_release",
+            {
+                "url": url,
+                "etag": resp.headers.get("ETag"),
+                "checked_at": time.time(),
+                "release": release,
+            },
+        )
+        return release
+
+    assert False, "no non-draft or non-prerelease release found"
+
+
+def get_current_executable_version(executable_path):
+    """ returns the version of the binary. It is cached on disk (keyed by the
+    binary's path, modification time and size), so that we don't have to run
+    it every time the editor starts """
+    signature = file_signature(executable_path)
+    if signature is None:
+        raise FileNotFoundError(executable_path)
+
+    versions = disk_cache.get("executable_versions") or {}
+    cached = versions.get(executable_path)
+    if cached is not None and cached["signature"] == list(signature):
+        return cached["version"]
+
+    version = run_executable_version(executable_path)
+    if version is not None:
+        versions[executable_path] = {
+            "signature": list(signature),
+            "version": version,
+        }
+        disk_cache.set("executable_versions", versions)
+    return version
+
+
+def run_executable_version(executable_path):
+    process = start_process([executable_path, "-version"])
+    try:
+        exit_code = process.wait(timeout=1)
+    except subprocess.TimeoutExpired:
+        kill_nicely(process)
+        return
+
+    if exit_code != 0:
+        notify("{} -version exited with code {}", executable_path, exit_code)
+        return None
+
+    return process.stdout.readline().decode("utf-8").split(" ")[0]
+
+
+def download(url, next_to):
+    """ streams url to a temporary file in the same directory as next_to (so that
+    it can be renamed over it). Returns (path, size, sha256 hex digest) """
+    # let any network error boil up the stack, it's cleaner when handled above
+    resp = requests.get(url, stream=True, timeout=HTTP_TIMEOUT)
+    assert (
+        resp.status_code == 200
+    ), "[downloading] expected 200 status code, got {}".format(resp.status_code)
+
+    hash = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(next_to), suffix=".tar.gz", delete=False
+    ) as target:
+        try:
+            for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                target.write(chunk)
+                hash.update(chunk)
+                size += len(chunk)
+        except BaseException:
+            target.close()
+            os.remove(target.name)
+            raise
+
+    return target.name, size, hash.hexdigest()
+
+
+def get_checksum(assets, archive_name):
+    """ returns the sha256 of archive_name listed in the release's checksums file,
+    or None if there isn't one """
+    for name, asset in assets.items():
+        if not name.endswith("checksums.txt"):
+            continue
+
+        resp = requests.get(asset["browser_download_url"], timeout=HTTP_TIMEOUT)
+        assert (
+            resp.status_code == 200
+        ), "[downloading checksums] expected 200 status code, got {}".format(
+            resp.status_code
+        )
+
+        # goreleaser's format: "<sha256>  <file name>" on each line
+        for line in resp.text.splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[1] == archive_name:
+                return parts[0].lower()
+
+    return None
+
+
+def extract_executable(archive_path, next_to):
+    """ extracts the jsoncomma binary from the archive to a temporary file in the
+    same directory as next_to. Returns the temporary file's path """
+    with tarfile.open(archive_path, mode="r:gz") as tar:
+        for tarinfo in tar.getmembers():
+            if tarinfo.name.startswith("jsoncomma"):
+                break
+        else:
+            assert False, "no jsoncomma binary in {}".format(tar.getnames())
+
+        notify("extracting file {!r}...", tarinfo.name)
+
+        fileobj = tar.extractfile(tarinfo)
+        assert fileobj is not None, "extracted {}, but got None".format(tarinfo.name)
+
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(next_to), delete=False
+        ) as target:
+            try:
+                shutil.copyfileobj(fileobj, target)
+            except BaseException:
+                target.close()
+                os.remove(target.name)
+                raise
+
+    return target.name
@@ -1,17 +1,282 @@
 import sublime
 import os
-import stat
-import requests
-import subprocess
+from . import fixer
+from .stats import recorder
+from .tracing import tracer
+from .transport import (
+    CONNECTION_ERRORS,
+    HTTPTransport,
+    UnixTransport,
+    StdioTransport,
+    default_socket_path,
+)
 import json
-import tarfile
-import shutil
-import io
+import time
+import socket
+import threading
+import hashlib
+import collections
+import codecs
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
 
 
 SETTINGS = "JSONComma.sublime-settings"
 SETTINGS_EXECUTABLE = "executable_path"
 SETTINGS_AUTO_UPDATE = "automatically_update_executable"
+SETTINGS_LOCAL_FIX_THRESHOLD = "local_fix_threshold"
+SETTINGS_LOCAL_FALLBACK = "fix_without_server"
+SETTINGS_RELEASE_API_URL = "release_api_url"
+SETTINGS_RELEASE_DOWNLOAD_URL = "release_download_url"
+SETTINGS_UPDATE_CHECK_INTERVAL = "update_check_interval_hours"
+SETTINGS_TRANSPORT = "transport"
+SETTINGS_SOCKET_PATH = "socket_path"
+SETTINGS_IDLE_SHUTDOWN = "idle_shutdown_minutes"
+SETTINGS_TRACE = "trace_requests"
+SETTINGS_TRACE_PATH = "trace_path"
+SETTINGS_TRACE_MAX_SIZE = "trace_max_size_mb"
+SETTINGS_TRACE_SAMPLE_SIZE = "trace_sample_size"
+
+# the states of the server's lifecycle (server.state)
+STOPPED = "stopped"  # not running, and nobody asked for it
+STARTING = "starting"
+READY = "ready"
+UPDATING = "updating"  # stopped to replace the binary, will be restarted
+FAILED = "failed"  # should be running, but isn't. The supervisor retries
+
+# how often (in seconds) the supervisor checks that a ready server is still alive
+HEALTH_CHECK_INTERVAL = 30
+# how long (in seconds) the supervisor waits before restarting a failed server.
+# It doubles after every failed attempt
+MIN_RESTART_BACKOFF = 1
+MAX_RESTART_BACKOFF = 60
+
+# when the server isn't available, text up to this size (in characters) is fixed
+# in process. Above that, it's too slow, so the fix waits for the server
+MAX_LOCAL_FALLBACK_SIZE = 1024 * 1024
+
+# the size of the chunks (in bytes) we read the server's response in, when
+# streaming large files
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# how many requests we send to the server at the same time when fixing many
+# regions at once
+MAX_CONCURRENT_FIXES = 8
+
+# total size (in characters) of the fixed texts we keep around
+CACHE_MAX_SIZE = 32 * 1024 * 1024
+
+# how long (in seconds) we wait for the server to answer a request: a base
+# amount, plus the time it would take to fix the payload at a (very) slow
+# throughput, so that huge files aren't cut off
+READ_TIMEOUT = 2
+MIN_SERVER_THROUGHPUT = 2 * 1024 * 1024
+# the server waits for its handlers before answering /shutdown
+STOP_TIMEOUT = 5
+
+# after this many failures (timeouts, connection errors, bad responses) in a row,
+# we stop sending anything to the server for BREAKER_COOLDOWN seconds
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 60
+
+# how long (in seconds) we wait for another thread or editor instance to finish
+# starting/updating the server (it might be downloading it)
+LIFECYCLE_LOCK_TIMEOUT = 120
+
+
+class FixCache:
+
+    """ A LRU cache of the server's responses, keyed by a hash of the request.
+
+    A lot of saves send text that hasn't changed since last time (save all,
+    repeated ctrl+s, cloned views, etc), this saves us the round trip.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            fixed = self._entries.get(key)
+            if fixed is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return fixed
+
+    def put(self, key, fixed):
+        if len(fixed) > self.max_size:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+
+            self._entries[key] = fixed
+            self.size += len(fixed)
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __str__(self):
+        return "{} hits, {} misses, {} entries ({} characters)".format(
+            self.hits, self.misses, len(self._entries), self.size
+        )
+
+
+class CircuitBreaker:
+
+    """ Stops us from hammering (and waiting for) a server which keeps failing.
+
+    It's closed while things work. After `threshold` failures in a row, it
+    opens: nothing is sent to the server for `cooldown` seconds. After that, it
+    lets one request through (half open): if it works, the breaker closes
+    again, otherwise it opens for another cool-down.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half open"
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at < self.cooldown:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self):
+        """ whether a request should be sent to the server """
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def succeeded(self):
+        """ returns True if it closed the breaker """
+        with self._lock:
+            was_open = self._opened_at is not None
+            self.failures = 0
+            self._opened_at = None
+            self._trial = False
+            return was_open
+
+    def failed(self):
+        """ returns True if it opened the breaker (it wasn't already) """
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self._opened_at is not None:
+                # the trial request failed, another cool-down
+                self._opened_at = time.monotonic()
+                return False
+            if self.failures < self.threshold:
+                return False
+            self._opened_at = time.monotonic()
+            self.opened += 1
+            return True
+
+    def __str__(self):
+        with self._lock:
+            state = self._state()
+            if state == self.OPEN:
+                return "open ({} failures, retrying in {:.0f}s)".format(
+                    self.failures,
+                    self.cooldown - (time.monotonic() - self._opened_at),
+                )
+            return "{} ({} failures in a row, opened {} times)".format(
+                state, self.failures, self.opened
+            )
+
+
+class LifecycleLock:
+
+    """ A re-entrant lock shared by the threads of this process, and by the
+    other processes using jsoncomma (other sublime text instances) through a
+    lock file. The operating system releases it if the process holding it dies,
+    so there is no stale lock to clean up. """
+
+    def __init__(self, get_path, timeout):
+        self._get_path = get_path
+        self._timeout = timeout
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        if not self._lock.acquire(timeout=self._timeout):
+            raise TimeoutError("timed out waiting for the lifecycle lock")
+        try:
+            if self._depth == 0:
+                self._file = self._lock_file()
+            self._depth += 1
+        except BaseException:
+            self._lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0:
+            unlock_file(self._file)
+            self._file.close()
+            self._file = None
+        self._lock.release()
+
+    def _lock_file(self):
+        path = self._get_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fp = open(path, "a+b")
+        deadline = time.monotonic() + self._timeout
+        while True:
+            try:
+                lock_file(fp)
+                return fp
+            except OSError:
+                if time.monotonic() > deadline:
+                    fp.close()
+                    raise TimeoutError("timed out waiting for {}".format(path))
+            time.sleep(0.05)
+
+
+class SpawnError(Exception):
+
+    """ the server process couldn't be started, or didn't say it started. Doing
+    the same thing again would fail the same way """
 
 
 class server:
@@ -23,6 +288,9 @@ class server:
     it). If we need to shut it down (for example to update), we send a
     /shutdown request because we have no guarantee that it is our process
     that owns the server process.
+
+    This is only true of the tcp and unix transports. With the stdio one, the
+    plugin owns the process (see transport.py).
     """
 
     # make sure we explicitely use IPv6 or IPv4, because otherwise, if the client
@@ -37,9 +305,217 @@ class server:
 
     downloading = False
 
+    # held while starting/updating the server, so that concurrent callers (in
+    # this process or another editor instance) wait for the one doing it rather
+    # than starting/downloading it again
+    lifecycle_lock = LifecycleLock(
+        lambda: os.path.join(server.get_data_path(), "jsoncomma.lock"),
+        LIFECYCLE_LOCK_TIMEOUT,
+    )
+
+    # how we talk to the server (see transport.py). It's only changed when the
+    # server (re)starts, because a running server only speaks one
+    _transport = None
+    _transport_lock = threading.Lock()
+    # the start settings (see start_settings) with which the server couldn't be
+    # spawned with the configured transport, so tcp is used instead
+    _tcp_fallback = None
+
+    cache = FixCache(CACHE_MAX_SIZE)
+
+    breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    # the lifecycle is tracked explicitly, so that fix knows right away whether
+    # it's worth sending anything, instead of finding out with a connection error
+    state = STOPPED
+    _state_changed = threading.Condition()
+    _start_requested = False
+    _supervisor = None
+    _ready_callbacks = []
+
+    # why the server isn't started automatically anymore (None if it is), see
+    # block_start. Changing the settings it was blocked with, or explicitly
+    # asking for a start, unblocks it
+    start_blocked = None
+    _blocked_settings = None
+    # spawn failures since the server was last ready
+    spawn_failures = 0
+    # the last reason we told the user the server wasn't used (tell_unavailable)
+    _unavailable_reason = None
+
+    # time.monotonic() of the last fix, the server is shut down once it's been
+    # idle for idle_shutdown_minutes
+    last_activity = 0
+
+    #
+    # lifecycle
+    #
+
+    @classmethod
+    def set_state(cls, state):
+        with cls._state_changed:
+            if cls.state == state:
+                return
+            print("JSONComma: server {} -> {}".format(cls.state, state))
+            cls.state = state
+            callbacks = []
+            if state == READY:
+                callbacks, cls._ready_callbacks = cls._ready_callbacks, []
+                cls.spawn_failures = 0
+                cls._unavailable_reason = None
+                # a server which was just started isn't idle
+                cls.last_activity = time.monotonic()
+                # the supervisor exits when the server stops, which is also what
+                # happens when an update replaces the binary
+                cls._start_supervisor()
+            cls._state_changed.notify_all()
+
+        for callback in callbacks:
+            callback()
+
+    @classmethod
+    def when_ready(cls, callback):
+        """ calls callback (from whatever thread) once the server is ready, or
+        right away if it already is """
+        with cls._state_changed:
+            if cls.state != READY:
+                cls._ready_callbacks.append(callback)
+                return
+        callback()
+
+    @classmethod
+    def ensure_started(cls, *, explicit=False):
+        """ asks the supervisor to start the server if it isn't running, unless
+        starting it is blocked and explicit is False (the user didn't ask for
+        it). This doesn't block """
+        with cls._state_changed:
+            if explicit or cls._blocked_settings != start_settings():
+                cls.start_blocked = None
+            if cls.start_blocked is not None:
+                return
+            if cls.state in (STOPPED, FAILED):
+                cls._start_requested = True
+            cls._start_supervisor()
+            cls._state_changed.notify_all()
+
+    @classmethod
+    def _start_supervisor(cls):
+        """ must be called with _state_changed held """
+        if cls._supervisor is None:
+            cls._supervisor = threading.Thread(target=cls.supervise, daemon=True)
+            cls._supervisor.start()
+
+    @classmethod
+    def block_start(cls, reason):
+        """ stops starting the server automatically, until the settings change
+        or a start is explicitly asked for """
+        with cls._state_changed:
+            cls.start_blocked = reason
+            cls._blocked_settings = start_settings()
+
+    @classmethod
+    def supervise(cls):
+        """ starts the server when asked to, restarts it (with an exponential
+        backoff) when it fails, and probes it regularly while it's ready. It
+        shuts it down once it's been idle for too long, and exits once the
+        server is stopped and nobody wants it anymore. """
+        backoff = MIN_RESTART_BACKOFF
+        next_attempt = time.monotonic()
+        while True:
+            with cls._state_changed:
+                while True:
+                    now = time.monotonic()
+                    if cls._start_requested or (
+                        cls.state in (FAILED, READY) and now >= next_attempt
+                    ):
+                        break
+                    if cls.state == STOPPED:
+                        cls._supervisor = None
+                        return
+                    timeout = None
+                    if cls.state in (FAILED, READY):
+                        timeout = next_attempt - now
+                    cls._state_changed.wait(timeout)
+
+                requested = cls._start_requested
+                start = requested or cls.state == FAILED
+                cls._start_requested = False
+
+            if not requested and cls.is_idle():
+                if cls.state == FAILED:
+                    # nobody needs it, stop retrying
+                    cls.set_state(STOPPED)
+                else:
+                    notify(
+                        "no fixes in the last {} minutes, shutting the server down",
+                        sublime.load_settings(SETTINGS).get(SETTINGS_IDLE_SHUTDOWN),
+                    )
+                    cls.release()
+                continue
+
+            if not start:
+                if cls.probe():
+                    next_attempt = time.monotonic() + HEALTH_CHECK_INTERVAL
+                else:
+                    notify("server stopped responding, restarting it")
+                    cls.set_state(FAILED)
+                    next_attempt = time.monotonic()
+                continue
+
+            try:
+                cls.start()
+            except Exception as e:
+                print("JSONComma: failed to start the server:", e)
+                cls.set_state(FAILED)
+
+            if cls.state == READY:
+                backoff = MIN_RESTART_BACKOFF
+                next_attempt = time.monotonic() + HEALTH_CHECK_INTERVAL
+            else:
+                next_attempt = time.monotonic() + backoff
+                backoff = min(backoff * 2, MAX_RESTART_BACKOFF)
+
+    @classmethod
+    def is_idle(cls):
+        minutes = sublime.load_settings(SETTINGS).get(SETTINGS_IDLE_SHUTDOWN, 0)
+        return 0 < minutes * 60 <= time.monotonic() - cls.last_activity
+
+    @classmethod
+    def release(cls):
+        """ stops the server, unless another editor instance started it and still
+        uses it (in which case we just stop using it) """
+        transport = cls.get_transport()
+        record = read_record(cls.get_record_path())
+        if (
+            record is not None
+            and record.get("address") == str(transport)
+            and record.get("owner") != os.getpid()
+            and process_is_running(record.get("owner"))
+        ):
+            transport.close()
+            cls.set_state(STOPPED)
+            return
+        cls.stop()
+
+    @classmethod
+    def probe(cls):
+        """ returns True if the server answers (fixing nothing is cheap) """
+        try:
+            status, _, _ = cls.get_transport().request(
+                "POST", "/", b"", timeout=READ_TIMEOUT
+            )
+        except CONNECTION_ERRORS:
+            return False
+        return status == 200
+
     @classmethod
     def start(cls):
-        """ Starts the server, downloading updates if needed
+        """ Starts the server, downloading updates if needed. Only one thread (or
+        editor instance) does it at a time: the others wait for it, and then use
+        the server it started.
         """
 
         # this is some bad logic, but it needs to cover all those paths
@@ -49,68 +525,217 @@ class server:
         # auto updates off, exectuable exists (start process)
         # TODO: add in yes/no from user
 
-        settings = sublime.load_settings(SETTINGS)
-
-        if settings.get(SETTINGS_AUTO_UPDATE):
-            executable_path = cls.get_default_executable_path(expand_vars=True)
-        else:
-            executable_path = settings.get(SETTINGS_EXECUTABLE)
-            executable_path = os.path.expanduser(os.path.expandvars(executable_path))
+        with cls.lifecycle_lock:
+            settings = sublime.load_settings(SETTINGS)
+            if cls.state == READY:
+                # another thread started it while we were waiting for the lock
+                return
+            cls.set_state(STARTING)
+            cls.reload_transport()
 
-        if not os.path.exists(executable_path) and not fixed_wrong_location(
-            executable_path
-        ):
+            if cls.adopt():
+                return
 
-            if not confirm_automatic_download(executable_path):
-                notify(
-                    "no binary found, and automatic updates disabled. JSONComma will not work"
+            if settings.get(SETTINGS_AUTO_UPDATE):
+                executable_path = cls.get_default_executable_path(expand_vars=True)
+            else:
+                executable_path = settings.get(SETTINGS_EXECUTABLE)
+                executable_path = os.path.expanduser(
+                    os.path.expandvars(executable_path)
                 )
-                settings.set(SETTINGS_AUTO_UPDATE, False)
-                sublime.save_settings(SETTINGS)
-                return
 
-            settings.set(SETTINGS_AUTO_UPDATE, True)
-            sublime.save_settings(SETTINGS)
-            executable_path = cls.get_default_executable_path(expand_vars=True)
+            if not os.path.exists(executable_path) and not fixed_wrong_location(
+                executable_path
+            ):
 
-        if settings.get(SETTINGS_AUTO_UPDATE):
-            try:
-                cls.auto_update_executable()
-            except requests.ConnectionError as e:
-                print("JSONComma:", e)
-                if not os.path.exists(executable_path):
+                if not confirm_automatic_download(executable_path):
                     notify(
-                        "failed to download server due to network error, JSONComma won't work"
+                        "no binary found, and automatic updates disabled. JSONComma will not work"
                     )
+                    settings.set(SETTINGS_AUTO_UPDATE, False)
+                    sublime.save_settings(SETTINGS)
+                    # don't ask again on every fix
+                    cls.block_start("no jsoncomma binary (the download was declined)")
+                    cls.set_state(STOPPED)
                     return
-                else:
+
+                settings.set(SETTINGS_AUTO_UPDATE, True)
+                sublime.save_settings(SETTINGS)
+                executable_path = cls.get_default_executable_path(expand_vars=True)
+
+            started_at = time.monotonic()
+
+            if settings.get(SETTINGS_AUTO_UPDATE) and os.path.exists(executable_path):
+                # don't make the user wait for GitHub before they can fix anything:
+                # start the current version right away, and check for updates in
+                # the background (auto_update_executable stops the server if it
+                # needs to replace the binary, so we restart it after)
+                cls.launch(executable_path)
+                if cls.state == READY:
+                    recorder.record("startup.ready", time.monotonic() - started_at)
                     notify(
-                        "failed to automatically download server due to network error, running current version"
+                        "startup: server ready after {:.0f}ms",
+                        (time.monotonic() - started_at) * 1000,
                     )
 
-        # we don't store the process, see comment under server
-        process = start_process(
-            [
-                executable_path,
-                "server",
-                "-host",
-                server.HOST,
-                "-port",
-                str(server.PORT),
-            ],
+                def update_in_background():
+                    update_started_at = time.monotonic()
+                    try:
+                        with cls.lifecycle_lock:
+                            if cls.try_auto_update(executable_path):
+                                # the new binary might support the configured
+                                # transport
+                                cls._tcp_fallback = None
+                                cls.set_state(STARTING)
+                                cls.reload_transport()
+                                cls.launch(executable_path)
+                    except Exception as e:
+                        # the supervisor will restart the server
+                        print("JSONComma: failed to update the server:", e)
+                        cls.set_state(FAILED)
+                        return
+                    recorder.record(
+                        "startup.update_check", time.monotonic() - update_started_at
+                    )
+                    notify(
+                        "startup: update check done in {:.0f}ms (in the background)",
+                        (time.monotonic() - update_started_at) * 1000,
+                    )
+
+                threading.Thread(target=update_in_background, daemon=True).start()
+                return
+
+            if settings.get(SETTINGS_AUTO_UPDATE):
+                cls.try_auto_update(executable_path)
+                if not os.path.exists(executable_path):
+                    cls.set_state(FAILED)
+                    return
+
+            cls.launch(executable_path)
+            if cls.state != READY:
+                return
+            recorder.record("startup.ready", time.monotonic() - started_at)
+            notify(
+                "startup: server ready after {:.0f}ms",
+                (time.monotonic() - started_at) * 1000,
+            )
+
+    @classmethod
+    def try_auto_update(cls, executable_path):
+        """ runs auto_update_executable, handling network errors. Returns True
+        if the binary was replaced """
+        from .lib import update
+
+        try:
+            previous = file_signature(executable_path)
+            cls.auto_update_executable()
+        except update.NETWORK_ERRORS as e:
+            print("JSONComma:", e)
+            if not os.path.exists(executable_path):
+                notify(
+                    "failed to download server due to network error, JSONComma won't work"
+                )
+            else:
+                notify(
+                    "failed to automatically download server due to network error, running current version"
+                )
+            return False
+
+        return file_signature(executable_path) != previous
+
+    @classmethod
+    def launch(cls, executable_path):
+        """ starts the server process, and waits for it to be listening. Sets the
+        state to ready or failed """
+        started_at = time.monotonic()
+        try:
+            with recorder.timer("startup.spawn"):
+                process = cls.spawn(executable_path)
+        except SpawnError as e:
+            transport = cls.get_transport()
+            if transport.name == "tcp":
+                cls.spawn_failed(e)
+                return
+            # most jsoncomma releases don't know the -socket and -stdio flags
+            notify(
+                "couldn't start the server with the {} transport ({}), using tcp",
+                transport.name,
+                e,
+            )
+            cls._tcp_fallback = start_settings()
+            cls.reload_transport()
+            cls.launch(executable_path)
+            return
+        except BaseException:
+            cls.set_state(FAILED)
+            raise
+
+        if not cls.probe():
+            cls.set_state(FAILED)
+            return
+        print(
+            "JSONComma: spawning the server took {:.0f}ms".format(
+                (time.monotonic() - started_at) * 1000
+            )
         )
 
+        transport = cls.get_transport()
+        if process is not None and not isinstance(transport, StdioTransport):
+            # so that the other editor instances use it instead of starting theirs
+            write_record(
+                cls.get_record_path(),
+                {
+                    "pid": process.pid,
+                    # the plugin host which started it
+                    "owner": os.getpid(),
+                    "transport": transport.name,
+                    "address": str(transport),
+                    "executable": executable_path,
+                },
+            )
+        cls.set_state(READY)
+
+    @classmethod
+    def adopt(cls):
+        """ uses the server started by another editor instance, if it's still
+        running. Returns True if it did (the state is then ready) """
+        transport = cls.get_transport()
+        if isinstance(transport, StdioTransport):
+            # nobody else can talk to our process
+            return False
+
+        record = read_record(cls.get_record_path())
+        if (
+            record is None
+            or record.get("address") != str(transport)
+            or not process_is_running(record.get("pid"))
+            or not cls.probe()
+        ):
+            return False
+
+        notify("using the server started by process {}", record["pid"])
+        cls.set_state(READY)
+        return True
+
+    @classmethod
+    def spawn(cls, executable_path):
+
+        transport = cls.get_transport()
+        try:
+            process = start_process(
+                [executable_path, "server"] + transport.server_args(),
+                **transport.process_options()
+            )
+        except OSError as e:
+            raise SpawnError("couldn't run {} ({})".format(executable_path, e))
+
         line = process.stdout.readline().decode("utf-8")
         try:
             infos = json.loads(line)
         except ValueError as e:
-            sublime.error_message(
-                "Failed to start jsoncomma server.\n\n{}\n\nMore details in the console".format(
-                    e
-                )
-            )
             print("JSONComma: output from the server: {!r}".format(line))
-            raise e
+            kill_nicely(process)
+            raise SpawnError("unexpected output from the server ({})".format(e))
 
         assert "kind" in infos, "expected 'kind' field in {}".format(infos)
 
@@ -123,22 +748,34 @@ class server:
                 print("JSONComma: unexpected error trying to open new server", infos)
 
             print("JSONComma: assume already running")
-            return
+            return None
 
         assert infos["kind"] == "started", "expected started kind in {}".format(infos)
 
         assert "addr" in infos, "server infos should include 'addr' ({})".format(infos)
-        assert "port" in infos, "server infos should include 'port' ({})".format(infos)
-        assert "host" in infos, "server infos should include 'host' ({})".format(infos)
-
-        # we can't assert about host because, for example, we might listen on "localhost",
-        # the server will reply 127.0.0.1. We could do gethostbyname, but that's probably
-        # an over kill
-        assert (
-            infos["port"] == server.PORT
-        ), "server started on port {}, expected {}".format(infos["port"], server.PORT)
+        transport.started(process, infos)
 
         notify("server {} started on {}", executable_path, infos["addr"])
+        return process
+
+    @classmethod
+    def spawn_failed(cls, error):
+        """ the server can't be spawned with the current settings, so retrying
+        on our own would only fail again. The user gets a dialog the first
+        time, and a status message the next ones """
+        cls.spawn_failures += 1
+        if cls.spawn_failures == 1:
+            sublime.error_message(
+                "Failed to start jsoncomma server.\n\n{}\n\nMore details in the console".format(
+                    error
+                )
+            )
+        notify(
+            "failed to start the server ({}), fix the settings or the binary and try again",
+            error,
+        )
+        cls.block_start("the server failed to start")
+        cls.set_state(STOPPED)
 
     @classmethod
     def stop(cls):
@@ -147,26 +784,19 @@ class server:
         This function blocks, because wait for the server to close all of it's handlers.
         """
 
+        transport = cls.get_transport()
         try:
-            resp = requests.get(
-                "http://{host}:{port}/shutdown".format(
-                    host=server.HOST, port=server.PORT
-                ),
-                stream=True,
-            )
-        except requests.ConnectionError as e:
-            # this is the best we can do to check that we got a ConnectionRefusedError
-            # after than, we get string, wtf urllib3. e.args[0].reason.args[0] is a
-            # string.
-            # we could try to parse the string... But that's not worth it.
-            assert isinstance(
-                e.args[0].reason,
-                requests.packages.urllib3.exceptions.NewConnectionError,
-            ), "expected NewConnectionError, got {}".format(e.args[0].reason)
-            # the server isn't running
+            _, _, body = transport.request("GET", "/shutdown", timeout=STOP_TIMEOUT)
+        except CONNECTION_ERRORS as e:
+            if isinstance(e, socket.timeout):
+                notify("no answer to /shutdown after {}s, giving up", STOP_TIMEOUT)
+            # otherwise the server isn't running
+            transport.close()
+            remove_record(cls.get_record_path(), str(transport))
+            cls.set_state(STOPPED)
             return
 
-        line = resp.raw.readline().decode("utf-8")
+        line = body.decode("utf-8").split("\n", 1)[0]
         try:
             data = json.loads(line)
         except ValueError as e:
@@ -177,193 +807,346 @@ class server:
             "timedout" in data
         ), "response should include 'timedout' field ({})".format(data)
 
+        transport.close()
+        remove_record(cls.get_record_path(), str(transport))
+        cls.set_state(STOPPED)
+
         if data["timedout"] is True:
             notify("JSONComma: server aborted")
         else:
             notify("JSONComma: server gracefully shutdown")
 
     @classmethod
-    def fix(cls, json_to_fix):
+    def fix(cls, json_to_fix, *, regions=1):
+        """ returns the fixed text, or None. regions is how many texts are being
+        fixed together (it's only used for the trace) """
+        settings = sublime.load_settings(SETTINGS)
+        if not settings.get(SETTINGS_TRACE, False):
+            return cls._fix(json_to_fix, settings)[0]
+
+        tracer.configure(
+            settings.get(SETTINGS_TRACE_PATH) or cls.get_default_trace_path(),
+            max_size=settings.get(SETTINGS_TRACE_MAX_SIZE, 16) * 1024 * 1024,
+            sample_size=settings.get(SETTINGS_TRACE_SAMPLE_SIZE, 0),
+        )
+        at = time.time()
+        started_at = time.perf_counter()
+        fixed, source = cls._fix(json_to_fix, settings)
+        tracer.record(
+            json_to_fix,
+            at=at,
+            duration=time.perf_counter() - started_at,
+            regions=regions,
+            source=source,
+            fixed=fixed,
+        )
+        return fixed
+
+    @classmethod
+    def _fix(cls, json_to_fix, settings):
+        """ returns (the fixed text or None, where it came from: "local",
+        "cache", "server" or "error") """
+        # for small payloads, the round trip to the server costs more than fixing
+        # it ourselves
+        if len(json_to_fix) < settings.get(SETTINGS_LOCAL_FIX_THRESHOLD, 0):
+            with recorder.timer("fix.local", len(json_to_fix)):
+                return fixer.fix(json_to_fix), "local"
+
+        encoded = json_to_fix.encode("utf-8")
+        key = hashlib.sha1(encoded).digest()
+        fixed = cls.cache.get(key)
+        if fixed is not None:
+            return fixed, "cache"
+
+        cls.last_activity = time.monotonic()
+        if cls.state != READY:
+            cls.ensure_started()
+            reason = cls.start_blocked or "server {}".format(cls.state)
+            return cls.fix_without_server(json_to_fix, reason), "local"
+
+        if not cls.breaker.allow():
+            # we already told the user when it opened
+            return cls.fix_without_server(json_to_fix, None), "local"
+
         try:
-            resp = requests.post(
-                "http://{host}:{port}".format(port=server.PORT, host=server.HOST),
-                data=json_to_fix,
+            status, content_type, body = cls.get_transport().request(
+                "POST", "/", encoded, timeout=request_timeout(len(encoded))
             )
-        except requests.ConnectionError as e:
-            if cls.downloading:
-                notify("downloading/updating the server, please wait")
-                return
-            cls.start()
-            notify(
-                "connection error with server ({}), started server, gave up trying to correct (save again to trigger)",
-                e,
+        except socket.timeout as e:
+            # it's alive, just slow (or wedged). Restarting it wouldn't help
+            cls.failed("the server didn't answer in time ({})".format(e))
+            return cls.fix_without_server(json_to_fix, None), "error"
+        except CONNECTION_ERRORS as e:
+            cls.set_state(FAILED)
+            cls.ensure_started()
+            cls.failed("connection error with server ({})".format(e))
+            return (
+                cls.fix_without_server(
+                    json_to_fix, "connection error with server ({})".format(e)
+                ),
+                "error",
             )
-            return
 
-        if resp.status_code != 200:
+        if status != 200:
             print("response from JSONComma server:")
-            print(resp)
+            print(body)
             notify(
-                "invalid response code from server (got {}, expected 200)",
-                resp.status_code,
+                "invalid response code from server (got {}, expected 200)", status
             )
-            return
+            cls.failed("invalid responses from the server")
+            return None, "error"
 
-        if resp.headers["Content-Type"] != "text/plain; charset=utf-8":
+        if content_type != "text/plain; charset=utf-8":
             print("response from JSONComma server:")
-            print(resp)
+            print(body)
             notify(
                 "invalid header 'Content-Type' (got {!r}, expected 'text/plain; charset=utf-8')",
-                resp.headers["Content-Type"],
+                content_type,
             )
-            return
-
-        return resp.text
+            cls.failed("invalid responses from the server")
+            return None, "error"
 
-    #
-    # downloading/updating the binary
-    #
+        cls.succeeded()
+        fixed = body.decode("utf-8")
+        cls.cache.put(key, fixed)
+        return fixed, "server"
 
     @classmethod
-    def auto_update_executable(cls):
-        """ install the binary in the right location, and store the path in settings.
-        It returns the location of the binary. This function blocks. """
+    def failed(cls, reason):
+        """ records a failed request. The user is told once, when the breaker
+        opens, rather than on every save """
+        if cls.breaker.failed():
+            notify(
+                "{}, not using the server for {}s (failed {} times in a row)",
+                reason,
+                cls.breaker.cooldown,
+                cls.breaker.failures,
+            )
 
-        assert (
-            cls.downloading is False
-        ), "auto_update_executable called already (cls.downloading: {})".format(
-            cls.downloading
-        )
+    @classmethod
+    def succeeded(cls):
+        if cls.breaker.succeeded():
+            notify("the server is working again")
 
-        executable_path = cls.get_default_executable_path(expand_vars=True)
+    @classmethod
+    def fix_chunks(cls, read_chunks, size):
+        """ streams the text to fix to the server as a chunked upload, and
+        returns an iterator over the fixed text (in chunks), or None if it
+        failed. read_chunks should return a new iterator over the text to fix
+        every time it's called (we might need to retry on a fresh connection).
+        size is the (approximate) size of the text, for the timeout.
+
+        Only a chunk of the request and of the response are in memory at a time,
+        this is what makes fixing huge files possible. Iterating over the result
+        raises CONNECTION_ERRORS if the connection breaks in the middle (the
+        failure is reported to the breaker first).
+        """
+        cls.last_activity = time.monotonic()
+        if cls.state != READY:
+            cls.ensure_started()
+            cls.tell_unavailable(
+                cls.start_blocked or "server {}".format(cls.state),
+                "will fix once the server is ready",
+            )
+            return None
 
-        cls.downloading = True
+        if not cls.breaker.allow():
+            return None
 
-        latest_version = cls.get_latest_version()
+        def read_encoded():
+            for chunk in read_chunks():
+                yield chunk.encode("utf-8")
 
         try:
-            current_version = cls.get_current_executable_version(executable_path)
-        except FileNotFoundError as e:
-            # we are going to download it
-            notify(
-                "current version: non existent ({!r}), latest version: {}",
-                e,
-                latest_version,
+            resp = cls.get_transport().stream(
+                "POST", "/", read_encoded, timeout=request_timeout(size)
             )
-        else:
-            if current_version == latest_version:
-                # don't need to update
-                cls.downloading = False
-                return executable_path
+        except socket.timeout as e:
+            cls.failed("the server didn't answer in time ({})".format(e))
+            return None
+        except CONNECTION_ERRORS as e:
+            cls.set_state(FAILED)
+            cls.ensure_started()
+            notify("connection error with server ({})", e)
+            cls.failed("connection error with server ({})".format(e))
+            return None
 
+        if resp.status != 200 or resp.content_type != "text/plain; charset=utf-8":
+            resp.close()
             notify(
-                "current version: {}, latest version: {}".format(
-                    current_version, latest_version
-                )
-            )
-
-        platforms = {
-            # sublime.plaform() -> goreleaser's platform names
-            "windows": "Windows",
-            "osx": "Darwin",
-            "linux": "Linux",
-        }
-
-        archs = {
-            # sublime.arch() -> goreleaser's arch names
-            "x32": "i386",
-            "x64": "x86_64",
-        }
-
-        download_url = (
-            "https://github.com/jsoncomma/jsoncomma/releases/download/"
-            "v{version}/jsoncomma_v{version}_{platform}_{arch}.tar.gz".format(
-                version=latest_version,
-                platform=platforms[sublime.platform()],
-                arch=archs[sublime.arch()],
+                "invalid response from server (got {} {!r}, expected 200 'text/plain; charset=utf-8')",
+                resp.status,
+                resp.content_type,
             )
-        )
+            cls.failed("invalid responses from the server")
+            return None
 
-        notify("downloading binary from {}", download_url)
+        def read():
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            try:
+                with recorder.timer("server.stream", resp.sent):
+                    while True:
+                        try:
+                            data = resp.read(STREAM_CHUNK_SIZE)
+                        except socket.timeout as e:
+                            cls.failed(
+                                "the server didn't answer in time ({})".format(e)
+                            )
+                            raise
+                        except CONNECTION_ERRORS as e:
+                            cls.set_state(FAILED)
+                            cls.ensure_started()
+                            cls.failed("connection error with server ({})".format(e))
+                            raise
+                        if not data:
+                            break
+                        yield decoder.decode(data)
+                    # only now: the server might stall after sending the headers
+                    cls.succeeded()
+                    yield decoder.decode(b"", final=True)
+            finally:
+                resp.close()
+
+        return read()
 
-        # We don't stream the download because tarfile can't extract file if you
-        # don't have a seek method (and setting stream=True gives you a file object
-        # without seek)
-        # let any network error boil up the stack, it's cleaner when handled above
-        resp = requests.get(download_url)
-        assert (
-            resp.status_code == 200
-        ), "[downloading] expected 200 status code, got {}".format(resp.status_code)
+    @classmethod
+    def fix_without_server(cls, json_to_fix, reason):
+        """ fixes small enough text in process (if the fix_without_server setting
+        allows it). Returns None otherwise, callers can use when_ready to try
+        again once the server is available. The user is told why (unless reason
+        is None) """
+        settings = sublime.load_settings(SETTINGS)
+        if (
+            not settings.get(SETTINGS_LOCAL_FALLBACK, False)
+            or len(json_to_fix) > MAX_LOCAL_FALLBACK_SIZE
+        ):
+            cls.tell_unavailable(reason, "will fix once the server is ready")
+            return None
 
-        os.makedirs(os.path.dirname(executable_path), exist_ok=True)
+        cls.tell_unavailable(reason, "fixed without it")
+        with recorder.timer("fix.local", len(json_to_fix)):
+            return fixer.fix(json_to_fix)
 
-        # make sure the server is stopped before we update the binary
-        cls.stop()
+    @classmethod
+    def tell_unavailable(cls, reason, outcome):
+        """ tells the user why the server wasn't used (unless reason is None).
+        Only once per reason until the server is ready again, not on every fix
+        (ie. every typing pause) """
+        if reason is None or reason == cls._unavailable_reason:
+            return
+        cls._unavailable_reason = reason
+        notify("{}, {}", reason, outcome)
 
-        notify("extracting tar...")
-        with open(executable_path, "wb") as target, tarfile.open(
-            mode="r:gz", fileobj=io.BytesIO(resp.content)
-        ) as tar:
+    @classmethod
+    def fix_many(cls, jsons_to_fix):
+        """ fixes every string concurrently (each worker has its own keep-alive
+        connection). Returns the results in the same order, None where the fix
+        failed """
+        if len(jsons_to_fix) <= 1:
+            return [cls.fix(json_to_fix) for json_to_fix in jsons_to_fix]
+
+        with cls._executor_lock:
+            if cls._executor is None:
+                import concurrent.futures
+
+                cls._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=MAX_CONCURRENT_FIXES
+                )
+        regions = len(jsons_to_fix)
+        return list(
+            cls._executor.map(
+                lambda json_to_fix: cls.fix(json_to_fix, regions=regions),
+                jsons_to_fix,
+            )
+        )
 
-            for tarinfo in tar.getmembers():
-                if tarinfo.name.startswith("jsoncomma"):
-                    break
+    #
+    # transport
+    #
 
-            notify("extracting file {!r}...", tarinfo.name)
+    @classmethod
+    def get_transport(cls):
+        with cls._transport_lock:
+            if cls._transport is None:
+                cls._transport = cls.create_transport()
+            return cls._transport
 
-            fileobj = tar.extractfile(tarinfo.name)
-            assert fileobj is not None, "extracted {}, but got None".format(
-                tarinfo.name
-            )
-            shutil.copyfileobj(fileobj, target)
+    @classmethod
+    def reload_transport(cls):
+        """ picks up changes to the transport settings. Must only be called when
+        the server isn't running """
+        transport = cls.create_transport()
+        with cls._transport_lock:
+            previous, cls._transport = cls._transport, transport
+        if previous is not None:
+            previous.close()
 
-        os.chmod(executable_path, os.stat(executable_path).st_mode | stat.S_IEXEC)
+    @classmethod
+    def create_transport(cls):
+        settings = sublime.load_settings(SETTINGS)
+        name = settings.get(SETTINGS_TRANSPORT) or "tcp"
 
-        cls.downloading = False
+        if name != "tcp" and cls._tcp_fallback == start_settings():
+            # see launch
+            name = "tcp"
 
-        # FIXME: maybe we should have a platform dependent settings file...
+        if name == "unix" and not hasattr(socket, "AF_UNIX"):
+            notify("unix sockets aren't supported on this platform, using tcp")
+            name = "tcp"
 
-    @classmethod
-    def get_latest_version(cls) -> str:
-        """ Gets the latest version from GitHub
-        """
-        notify("checking last release...")
-        resp = requests.get("https://api.github.com/repos/jsoncomma/jsoncomma/releases")
+        if name == "tcp":
+            return HTTPTransport(cls.HOST, cls.PORT)
+        if name == "unix":
+            socket_path = settings.get(SETTINGS_SOCKET_PATH) or default_socket_path()
+            return UnixTransport(os.path.expanduser(os.path.expandvars(socket_path)))
+        if name == "stdio":
+            return StdioTransport()
 
-        assert (
-            resp.status_code == 200
-        ), "[getting last release] expected 200 status code, got {}".format(
-            resp.status_code
-        )
+        notify("unknown transport {!r}, using tcp", name)
+        return HTTPTransport(cls.HOST, cls.PORT)
 
-        releases = resp.json()
-        for release in releases:
-            # ignore prereleases and drafts
-            if release["draft"] or release["prerelease"]:
-                continue
+    #
+    # downloading/updating the binary
+    #
 
-            assert release["tag_name"].startswith(
-                "v"
-            ), "expected tag name to start with 'v' in {!r}".format(release["tag_name"])
+    @classmethod
+    def auto_update_executable(cls):
+        """ install the binary in the right location, and store the path in settings.
+        It returns the location of the binary. This function blocks. """
+        # it's slow to import, and most of the time we don't need it at all
+        from .lib import update
+
+        with cls.lifecycle_lock:
+            # the lock is re-entrant, but we never update from an update
+            assert (
+                cls.downloading is False
+            ), "auto_update_executable called already (cls.downloading: {})".format(
+                cls.downloading
+            )
 
-            return release["tag_name"][1:]
+            executable_path = cls.get_default_executable_path(expand_vars=True)
 
-        assert False, "no non-draft or non-prerelease release found"
+            # if another instance updated it while we were waiting for the lock,
+            # update_executable finds it up to date (and the release is cached)
+            cls.downloading = True
+            try:
+                return update.update_executable(executable_path)
+            finally:
+                cls.downloading = False
 
     @classmethod
-    def get_current_executable_version(cls, executable_path):
-        process = start_process([executable_path, "-version"])
-        try:
-            exit_code = process.wait(timeout=1)
-        except subprocess.TimeoutExpired:
-            kill_nicely(process)
-            return
+    def get_data_path(cls):
+        """ jsoncomma's data directory (where the binary is downloaded), shared by
+        every editor instance """
+        return os.path.dirname(cls.get_default_executable_path(expand_vars=True))
 
-        if exit_code != 0:
-            notify("{} -version exited with code {}", executable_path, exit_code)
-            return None
+    @classmethod
+    def get_default_trace_path(cls):
+        return os.path.join(sublime.cache_path(), "JSONComma", "trace.jsonl")
 
-        return process.stdout.readline().decode("utf-8").split(" ")[0]
+    @classmethod
+    def get_record_path(cls):
+        return os.path.join(cls.get_data_path(), "server.json")
 
     @classmethod
     def get_default_executable_path(cls, *, expand_vars):
@@ -389,6 +1172,20 @@ class server:
         return path
 
 
+def start_settings():
+    """ the settings which decide how the server is started """
+    settings = sublime.load_settings(SETTINGS)
+    return tuple(
+        settings.get(key)
+        for key in (
+            SETTINGS_EXECUTABLE,
+            SETTINGS_AUTO_UPDATE,
+            SETTINGS_TRANSPORT,
+            SETTINGS_SOCKET_PATH,
+        )
+    )
+
+
 def confirm_automatic_download(current_path):
     # I'm not sure how I can make it clear that this is a one time thing.
     # if the user wants to update the server, he will have to do so manually
@@ -407,6 +1204,80 @@ def confirm_automatic_download(current_path):
     )
 
 
+def file_signature(path):
+    """ returns (modification time, size) of path, or None if it doesn't exist """
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+    return stat_result.st_mtime, stat_result.st_size
+
+
+def request_timeout(size):
+    """ how long (in seconds) we give the server to answer a request of size
+    bytes """
+    return READ_TIMEOUT + size / MIN_SERVER_THROUGHPUT
+
+
+def lock_file(fp):
+    """ locks fp without blocking. Raises OSError if it's already locked """
+    if os.name == "nt":
+        fp.seek(0)
+        msvcrt.locking(fp.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def unlock_file(fp):
+    if os.name == "nt":
+        fp.seek(0)
+        msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+def read_record(path):
+    """ the server record (pid, transport, address, executable), or None """
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def write_record(path, record):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as fp:
+        json.dump(record, fp)
+    os.replace(path + ".tmp", path)
+
+
+def remove_record(path, address):
+    """ removes the record if it's about the server at address """
+    record = read_record(path)
+    if record is not None and record.get("address") == address:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def process_is_running(pid):
+    if not isinstance(pid, int):
+        return False
+    if os.name == "nt":
+        # there is no cheap way to check, the probe will tell
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # it exists, it's just not ours
+        return True
+    return True
+
+
 def notify(format, *args, **kwargs):
     message = "JSONComma: " + format.format(*args, **kwargs)
     print(message)
@@ -414,6 +1285,10 @@ def notify(format, *args, **kwargs):
 
 
 def start_process(cmd, *args, **kwargs):
+    # not imported at the top: it's slow to import, and only needed once we start
+    # the server
+    import subprocess
+
     # hide the terminal window on Windows
     startupinfo = None
     if os.name == "nt":
@@ -435,6 +1310,8 @@ def kill_nicely(process, *, timeout=1):
     returns the exit code
     """
 
+    import subprocess
+
     process.terminate()
     try:
         return process.wait(timeout=timeout)
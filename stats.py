@@ -0,0 +1,114 @@
+""" Latency and throughput instrumentation.
+
+Every phase of a fix (reading the view, connecting, the request itself,
+applying the edits, starting the server...) is timed, and the last samples of
+each phase are kept to compute percentiles. Recording a sample is just an
+append to a bounded deque, so it's cheap enough to always be on.
+"""
+
+import collections
+import threading
+import time
+
+# how many samples we keep for each phase
+WINDOW = 1000
+
+
+class Recorder:
+    def __init__(self, window):
+        self.window = window
+        self._samples = {}
+        self._counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def record(self, phase, duration, size=None):
+        """ duration is in seconds, size (optional) in bytes/characters """
+        with self._lock:
+            samples = self._samples.get(phase)
+            if samples is None:
+                samples = self._samples[phase] = collections.deque(maxlen=self.window)
+            samples.append((duration, size))
+            self._counts[phase] += 1
+
+    def timer(self, phase, size=None):
+        """ a context manager recording how long its body took """
+        return Timer(self, phase, size)
+
+    def summary(self):
+        """ returns {phase: {count, p50, p95, p99, max, bytes_per_second}}, the
+        durations are in milliseconds """
+        with self._lock:
+            samples = {phase: list(samples) for phase, samples in self._samples.items()}
+            counts = dict(self._counts)
+
+        summary = {}
+        for phase, phase_samples in sorted(samples.items()):
+            durations = sorted(duration for duration, _ in phase_samples)
+            sized = [(duration, size) for duration, size in phase_samples if size]
+            bytes_per_second = None
+            if sized and sum(duration for duration, _ in sized) > 0:
+                bytes_per_second = sum(size for _, size in sized) / sum(
+                    duration for duration, _ in sized
+                )
+            summary[phase] = {
+                "count": counts[phase],
+                "p50": percentile(durations, 50) * 1000,
+                "p95": percentile(durations, 95) * 1000,
+                "p99": percentile(durations, 99) * 1000,
+                "max": durations[-1] * 1000,
+                "bytes_per_second": bytes_per_second,
+            }
+        return summary
+
+    def report(self):
+        """ a human readable table of the summary """
+        lines = [
+            "{:<24} {:>7} {:>9} {:>9} {:>9} {:>9} {:>10}".format(
+                "phase", "count", "p50 ms", "p95 ms", "p99 ms", "max ms", "MB/s"
+            )
+        ]
+        for phase, infos in self.summary().items():
+            throughput = "-"
+            if infos["bytes_per_second"] is not None:
+                throughput = "{:.2f}".format(infos["bytes_per_second"] / 1e6)
+            lines.append(
+                "{:<24} {:>7} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>10}".format(
+                    phase,
+                    infos["count"],
+                    infos["p50"],
+                    infos["p95"],
+                    infos["p99"],
+                    infos["max"],
+                    throughput,
+                )
+            )
+        return "\n".join(lines)
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+            self._counts.clear()
+
+
+class Timer:
+    def __init__(self, recorder, phase, size):
+        self.recorder = recorder
+        self.phase = phase
+        self.size = size
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter() - self.started_at
+        self.recorder.record(self.phase, duration, self.size)
+
+
+def percentile(sorted_values, percent):
+    """ nearest-rank percentile of an already sorted list """
+    index = max(0, -(-len(sorted_values) * percent // 100) - 1)
+    return sorted_values[int(index)]
+
+
+recorder = Recorder(WINDOW)
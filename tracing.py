@@ -0,0 +1,102 @@
+""" Records the requests to fix (opt-in, see the trace_* settings).
+
+Every call to server.fix is appended as a JSON line to a trace file: when it
+happened, how big the payload was, its sha1 (and optionally a sample of it),
+how many regions were fixed together, where the result came from and how long
+it took. bench/replay.py replays a trace against a server, to reproduce real
+save patterns offline.
+
+The file is rotated once it gets too big, so that leaving tracing on doesn't
+fill the disk.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+# how many rotated trace files (trace.jsonl.1, .2, ...) are kept
+BACKUPS = 3
+
+
+class Tracer:
+    def __init__(self):
+        self.path = None
+        self.max_size = 0
+        self.sample_size = 0
+        self._fp = None
+        self._lock = threading.Lock()
+
+    def configure(self, path, *, max_size, sample_size):
+        """ max_size is in bytes, sample_size in characters (-1 keeps the whole
+        payloads). Reopens the file if path changed """
+        with self._lock:
+            if path != self.path:
+                self._close()
+                self.path = path
+            self.max_size = max_size
+            self.sample_size = sample_size
+
+    def record(self, json_to_fix, *, at, duration, regions, source, fixed):
+        """ at is the wall clock time the fix started, duration is in seconds.
+        source is where the result came from: "local", "cache", "server" or
+        "error" (the server failed, fixed comes from the fallback if any) """
+        encoded = json_to_fix.encode("utf-8")
+        entry = {
+            "at": at,
+            "size": len(encoded),
+            "sha1": hashlib.sha1(encoded).hexdigest(),
+            "regions": regions,
+            "source": source,
+            "ok": fixed is not None,
+            "changed": fixed is not None and fixed != json_to_fix,
+            "latency_ms": duration * 1000,
+        }
+        if self.sample_size < 0:
+            entry["payload"] = json_to_fix
+        elif self.sample_size > 0:
+            entry["sample"] = json_to_fix[: self.sample_size]
+        line = json.dumps(entry) + "\n"
+
+        with self._lock:
+            try:
+                self._write(line)
+            except OSError as e:
+                print("JSONComma: couldn't write the trace {}: {}".format(self.path, e))
+                self._close()
+
+    def _write(self, line):
+        if self._fp is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._fp = open(self.path, "a", encoding="utf-8")
+
+        if 0 < self.max_size <= self._fp.tell() + len(line):
+            self._close()
+            self._rotate()
+            self._fp = open(self.path, "a", encoding="utf-8")
+
+        self._fp.write(line)
+        self._fp.flush()
+
+    def _rotate(self):
+        """ trace.jsonl becomes trace.jsonl.1, .1 becomes .2, etc """
+        for index in range(BACKUPS - 1, 0, -1):
+            older = "{}.{}".format(self.path, index)
+            if os.path.exists(older):
+                os.replace(older, "{}.{}".format(self.path, index + 1))
+        if BACKUPS > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+tracer = Tracer()
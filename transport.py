@@ -0,0 +1,490 @@
+""" How the plugin talks to the jsoncomma server.
+
+Three transports are available (see the "transport" setting):
+
+- tcp: HTTP on 127.0.0.1 (what jsoncomma does by default)
+- unix: HTTP over a unix domain socket, at a per user path. Cheaper than the
+  loopback, and nobody else can be listening on it
+- stdio: length prefixed frames over the stdin/stdout of a child process that
+  the plugin owns. No socket at all, and the server exits by itself when
+  sublime text does (its stdin gets closed)
+
+They all have the same interface: request returns (status, content type, body)
+and stream uploads the body as it is read and returns a StreamedResponse. They
+raise CONNECTION_ERRORS when the server can't be reached, and socket.timeout
+(one of them) when it doesn't answer within the timeout.
+
+The stdio frames are a 4 byte big endian length followed by that many bytes. A
+message is a header frame (b"POST /" for a request, b"200 text/plain;
+charset=utf-8" for a response), then the body's frames, then an empty frame.
+"""
+
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import weakref
+
+from .stats import recorder
+
+
+class ProtocolError(Exception):
+
+    """ the server's response isn't valid HTTP. It wraps http.client's errors,
+    so that catching CONNECTION_ERRORS doesn't need http.client to be imported """
+
+
+CONNECTION_ERRORS = (OSError, ProtocolError)
+
+FRAME_HEADER = struct.Struct(">I")
+
+# how long (in seconds) we wait for a connection to the server. It's local, so
+# if it takes longer than that, something's wrong
+CONNECT_TIMEOUT = 1
+
+# how long we give the stdio server to exit once its stdin is closed
+STDIO_EXIT_TIMEOUT = 1
+
+
+def connections():
+    """ the module with the HTTP connections, imported on first use """
+    from .lib import connections
+
+    return connections
+
+
+def raise_connection_error(e):
+    """ call from an except block: re-raises e, as one of CONNECTION_ERRORS """
+    if isinstance(e, OSError):
+        raise
+    raise ProtocolError(e) from e
+
+
+def default_socket_path():
+    """ a per user path, so that users don't share a server """
+    import tempfile
+
+    directory = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(directory, "jsoncomma-{}.sock".format(os.getuid()))
+
+
+class StreamedResponse:
+
+    """ a response read in chunks. It must be closed, which puts the connection
+    back in a usable state (or closes it if the body wasn't read completely) """
+
+    def __init__(self, status, content_type, read, release, sent):
+        self.status = status
+        self.content_type = content_type
+        self.read = read
+        self._release = release
+        # how many bytes of body were uploaded
+        self.sent = sent
+
+    def close(self):
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+
+
+class HTTPTransport:
+
+    """ HTTP over TCP, with a keep-alive connection per thread """
+
+    name = "tcp"
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        # http.client connections aren't thread safe, so each thread gets its own
+        # keep-alive connection. We also keep a (weak) reference to all of them so
+        # that we can close them all when the server stops.
+        self._local = threading.local()
+        self._connections = weakref.WeakSet()
+        self._connections_lock = threading.Lock()
+
+    def __str__(self):
+        return "{}:{}".format(self.host, self.port)
+
+    def server_args(self):
+        """ the arguments to pass to `jsoncomma server` """
+        return ["-host", self.host, "-port", str(self.port)]
+
+    def process_options(self):
+        """ extra arguments for subprocess.Popen """
+        return {}
+
+    def started(self, process, infos):
+        """ called once the server reported it started (infos is the first line
+        it printed). We don't keep the process, see the comment under server """
+        assert "port" in infos, "server infos should include 'port' ({})".format(infos)
+        assert "host" in infos, "server infos should include 'host' ({})".format(infos)
+
+        # we can't assert about host because, for example, we might listen on "localhost",
+        # the server will reply 127.0.0.1. We could do gethostbyname, but that's probably
+        # an over kill
+        assert (
+            infos["port"] == self.port
+        ), "server started on port {}, expected {}".format(infos["port"], self.port)
+
+    def new_connection(self):
+        return connections().HTTPConnection(self.host, self.port)
+
+    def connect(self, conn):
+        with recorder.timer("server.connect"):
+            conn.connect()
+        # requests are small and latency sensitive, don't let Nagle's
+        # algorithm hold them back
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def request(self, method, path, body=None, *, timeout=None):
+        """ sends a request to the server over this thread's keep-alive connection,
+        and returns (status, content type, body). timeout (in seconds) applies to
+        every read/write on the socket.
+
+        If a reused connection fails (for example because the server restarted
+        and closed it), it transparently reconnects once. Errors on a fresh
+        connection (ie. the server isn't running) and timeouts are raised.
+        """
+        conn = self.get_connection()
+        while True:
+            reused = conn.sock is not None
+            try:
+                if not reused:
+                    self.connect(conn)
+                conn.sock.settimeout(timeout)
+                with recorder.timer("server.request", len(body or b"")):
+                    conn.request(method, path, body=body)
+                    resp = conn.getresponse()
+                    return resp.status, resp.getheader("Content-Type"), resp.read()
+            except socket.timeout:
+                # retrying would just wait that long again
+                conn.close()
+                raise
+            except (OSError, connections().HTTPException) as e:
+                conn.close()
+                if reused:
+                    continue
+                raise_connection_error(e)
+
+    def stream(self, method, path, read_chunks, *, timeout=None):
+        """ uploads the body as a chunked request. read_chunks should return a new
+        iterator over the body (bytes) every time it's called, we might need to
+        retry on a fresh connection """
+        conn = self.get_connection()
+        while True:
+            reused = conn.sock is not None
+            try:
+                if not reused:
+                    self.connect(conn)
+                conn.sock.settimeout(timeout)
+                conn.putrequest(method, path)
+                conn.putheader("Transfer-Encoding", "chunked")
+                conn.putheader("Content-Type", "text/plain; charset=utf-8")
+                conn.endheaders()
+                sent = 0
+                for data in read_chunks():
+                    if not data:
+                        continue
+                    sent += len(data)
+                    conn.send("{:x}\r\n".format(len(data)).encode("ascii"))
+                    conn.send(data)
+                    conn.send(b"\r\n")
+                conn.send(b"0\r\n\r\n")
+                resp = conn.getresponse()
+                break
+            except socket.timeout:
+                conn.close()
+                raise
+            except (OSError, connections().HTTPException) as e:
+                conn.close()
+                if reused:
+                    continue
+                raise_connection_error(e)
+
+        def read(size):
+            try:
+                return resp.read(size)
+            except connections().HTTPException as e:
+                raise_connection_error(e)
+
+        def release():
+            # the rest of the response would be read as the next one's
+            if not resp.isclosed():
+                conn.close()
+
+        return StreamedResponse(
+            resp.status, resp.getheader("Content-Type"), read, release, sent
+        )
+
+    def get_connection(self):
+        conn = getattr(self._local, "connection", None)
+        if conn is None:
+            conn = self.new_connection()
+            self._local.connection = conn
+            with self._connections_lock:
+                self._connections.add(conn)
+        return conn
+
+    def close(self):
+        """ closes every keep-alive connection. They are reopened automatically
+        on their next request """
+        with self._connections_lock:
+            for conn in list(self._connections):
+                conn.close()
+
+
+class UnixTransport(HTTPTransport):
+
+    """ HTTP over a unix domain socket """
+
+    name = "unix"
+
+    def __init__(self, socket_path):
+        super().__init__("localhost", None)
+        self.socket_path = socket_path
+
+    def __str__(self):
+        return self.socket_path
+
+    def server_args(self):
+        return ["-socket", self.socket_path]
+
+    def started(self, process, infos):
+        pass
+
+    def new_connection(self):
+        return connections().UnixHTTPConnection(self.socket_path)
+
+    def connect(self, conn):
+        with recorder.timer("server.connect"):
+            conn.connect()
+
+
+class Watchdog:
+
+    """ kills a process which doesn't answer before the deadline. Pipes don't
+    have timeouts, this is how we get out of a read from a wedged server """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._process = None
+        self._deadline = None
+        self._thread = None
+        # whether the last deadline expired
+        self.expired = False
+
+    def arm(self, process, timeout):
+        if timeout is None:
+            return
+        with self._condition:
+            self._process = process
+            self._deadline = time.monotonic() + timeout
+            self.expired = False
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def disarm(self):
+        with self._condition:
+            self._process = None
+            self._deadline = None
+
+    def run(self):
+        with self._condition:
+            while True:
+                if self._deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = self._deadline - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                self.expired = True
+                self._process.kill()
+                self._process = None
+                self._deadline = None
+
+
+class StdioTransport:
+
+    """ frames over the pipes of a child process. There is only one pipe, so
+    requests are sent one at a time """
+
+    name = "stdio"
+
+    def __init__(self):
+        self._process = None
+        # held from the moment a request is sent until its response is read
+        self._lock = threading.Lock()
+        self._watchdog = Watchdog()
+
+    def __str__(self):
+        return "stdio"
+
+    def server_args(self):
+        return ["-stdio"]
+
+    def process_options(self):
+        import subprocess
+
+        # stdout carries the frames, so the logs can't go there
+        return {"stdin": subprocess.PIPE, "stderr": subprocess.DEVNULL}
+
+    def started(self, process, infos):
+        with self._lock:
+            previous, self._process = self._process, process
+        if previous is not None:
+            self.terminate(previous)
+
+    def request(self, method, path, body=None, *, timeout=None):
+        with self._lock:
+            process = self.get_process()
+            self._watchdog.arm(process, timeout)
+            try:
+                with recorder.timer("server.request", len(body or b"")):
+                    self.send(process, "{} {}".format(method, path).encode("ascii"))
+                    if body:
+                        self.send(process, body)
+                    self.send(process, b"")
+                    process.stdin.flush()
+                    status, content_type = self.read_header(process)
+                    body = []
+                    while True:
+                        frame = self.read_frame(process)
+                        if not frame:
+                            break
+                        body.append(frame)
+            except CONNECTION_ERRORS:
+                self.discard(process)
+                raise self.timed_out(timeout)
+            finally:
+                self._watchdog.disarm()
+        return status, content_type, b"".join(body)
+
+    def stream(self, method, path, read_chunks, *, timeout=None):
+        self._lock.acquire()
+        try:
+            process = self.get_process()
+            self._watchdog.arm(process, timeout)
+            try:
+                self.send(process, "{} {}".format(method, path).encode("ascii"))
+                sent = 0
+                for data in read_chunks():
+                    if not data:
+                        continue
+                    sent += len(data)
+                    self.send(process, data)
+                self.send(process, b"")
+                process.stdin.flush()
+                status, content_type = self.read_header(process)
+            except CONNECTION_ERRORS:
+                self.discard(process)
+                raise self.timed_out(timeout)
+            finally:
+                self._watchdog.disarm()
+        except BaseException:
+            self._lock.release()
+            raise
+
+        buffered = []
+        finished = False
+
+        def read(size):
+            nonlocal finished
+            if not buffered and not finished:
+                self._watchdog.arm(process, timeout)
+                try:
+                    frame = self.read_frame(process)
+                except CONNECTION_ERRORS:
+                    raise self.timed_out(timeout)
+                finally:
+                    self._watchdog.disarm()
+                if frame:
+                    buffered.append(frame)
+                else:
+                    finished = True
+            if not buffered:
+                return b""
+            data = buffered.pop()
+            if len(data) > size:
+                buffered.append(data[size:])
+                data = data[:size]
+            return data
+
+        def release():
+            # the rest of the response would be read as the next one's
+            try:
+                while read(1 << 20):
+                    pass
+            except CONNECTION_ERRORS:
+                self.discard(process)
+            finally:
+                self._lock.release()
+
+        return StreamedResponse(status, content_type, read, release, sent)
+
+    def get_process(self):
+        if self._process is None or self._process.poll() is not None:
+            raise ConnectionRefusedError("the stdio server isn't running")
+        return self._process
+
+    def send(self, process, data):
+        process.stdin.write(FRAME_HEADER.pack(len(data)))
+        process.stdin.write(data)
+
+    def read_frame(self, process):
+        header = self.read_exactly(process, FRAME_HEADER.size)
+        (length,) = FRAME_HEADER.unpack(header)
+        return self.read_exactly(process, length)
+
+    def read_exactly(self, process, size):
+        data = process.stdout.read(size)
+        if len(data) != size:
+            raise ConnectionResetError("the stdio server closed its output")
+        return data
+
+    def read_header(self, process):
+        header = self.read_frame(process).decode("utf-8")
+        status, _, content_type = header.partition(" ")
+        return int(status), content_type or None
+
+    def timed_out(self, timeout):
+        """ call from an except block: the error to raise instead """
+        if self._watchdog.expired:
+            return socket.timeout(
+                "the stdio server didn't answer in {}s".format(timeout)
+            )
+        return sys.exc_info()[1]
+
+    def discard(self, process):
+        """ after an error, we don't know where we are in the stream anymore """
+        if self._process is process:
+            self._process = None
+        self.terminate(process)
+
+    def terminate(self, process):
+        # closing stdin is how we ask it to exit
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+
+        import subprocess
+
+        try:
+            process.wait(timeout=STDIO_EXIT_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+
+    def close(self):
+        """ stops the child process """
+        with self._lock:
+            process, self._process = self._process, None
+        if process is not None:
+            self.terminate(process)